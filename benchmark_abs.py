@@ -0,0 +1,152 @@
+# Benchmarks the stages of source_abs.py on synthetic DataPacks
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import source_abs
+from synthetic_datapack import write_datapack
+
+"""Stage benchmarks
+
+Writes a synthetic DataPack (see synthetic_datapack.py) for every granularity and scale, then
+times every Load_* stage, reading its tables from CSV, and clean_up. Each timing is the best
+of --repeat runs. Tables are parsed from source every run (the table cache is not used).
+--readers c arrow arrow_dtypes also times parsing every table with each CSV reader.
+
+    python benchmark_abs.py --granularity POA SA1 --scale 0.1 0.5 1 --save-baseline
+    python benchmark_abs.py --granularity POA SA1 --scale 0.1 0.5 1
+
+The first command stores the timings in the baseline file. The second compares against it
+and exits with status 1 if a stage got slower by more than --threshold (a fraction of the
+baseline time) and by more than --min-seconds.
+"""
+
+STEPS = [(name, source_abs.PIPELINE[name]['func']) for name in source_abs.STAGES] + [('clean_up', None)]
+
+
+def time_stages(datapack_dir, granularity, repeat):
+    # Best time of every stage over repeat runs, on a fresh DataPack each run
+    best = {}
+    for _ in range(repeat):
+        results = {}
+        for name, func in STEPS:
+            pack = source_abs.DataPack(granularity, datapack_dir, cache=False)
+            start_time = time.perf_counter()
+            if func is None:
+                df_overview = source_abs.assemble(pack.index_code, *[results[stage] for stage in source_abs.STAGES])
+                start_time = time.perf_counter()
+                source_abs.clean_up(df_overview, pack.index_code)
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[name] = func(pack)
+            elapsed = time.perf_counter() - start_time
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return (best)
+
+
+def time_readers(datapack_dir, granularity, readers, repeat):
+    # Best time of parsing every table, with the columns its source reads, per reader
+    pack = source_abs.DataPack(granularity, datapack_dir, cache=False)
+    best = {}
+    for name, (_, cols, dtypes) in source_abs.SOURCES.items():
+        wanted, dtype = pack.column_spec(cols, dtypes)
+        for table in source_abs.source_tables(name):
+            source, member = pack.source(table)
+            for reader in readers:
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    source_abs.parse_part(source, member, granularity, wanted, dtype, reader)
+                    elapsed = time.perf_counter() - start_time
+                    key = 'read_' + table + '_' + reader
+                    best[key] = min(best.get(key, elapsed), elapsed)
+    return (best)
+
+
+def run_benchmarks(granularities, scales, repeat=3, data_dir=None, seed=0, readers=()):
+    # Timings keyed by 'granularity/scale/stage', plus the number of areas of every DataPack.
+    # With readers, every table is also parsed with each of them ('read_<table>_<reader>').
+    temp_dir = None
+    if data_dir is None:
+        data_dir = temp_dir = tempfile.mkdtemp(prefix='abs_benchmark_')
+    timings, areas = {}, {}
+    try:
+        for scale in scales:
+            datapack_dir = os.path.join(data_dir, 'scale_' + str(scale), '')
+            for gran in granularities:
+                areas[gran + '/' + str(scale)] = write_datapack(datapack_dir, gran, scale, seed)
+                best = time_stages(datapack_dir, gran, repeat)
+                best.update(time_readers(datapack_dir, gran, readers, repeat))
+                for stage, elapsed in best.items():
+                    timings[gran + '/' + str(scale) + '/' + stage] = elapsed
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return (timings, areas)
+
+
+def compare(timings, baseline, threshold, min_seconds):
+    # Keys of the timings that regressed against the baseline
+    regressions = []
+    for key, elapsed in timings.items():
+        before = baseline.get(key)
+        if before is not None and elapsed > before * (1 + threshold) and elapsed - before > min_seconds:
+            regressions.append(key)
+    return (regressions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages of source_abs.py on synthetic DataPacks.')
+    parser.add_argument('--granularity', nargs='+', choices=sorted(source_abs.INDEX_CODES),
+                        default=sorted(source_abs.INDEX_CODES), help='granularities to benchmark (default: all)')
+    parser.add_argument('--scale', nargs='+', type=float, default=[0.1, 1.0],
+                        help='DataPack sizes as fractions of the real DataPack (default: 0.1 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the best is kept (default: 3)')
+    parser.add_argument('--readers', nargs='+', default=[], choices=sorted(source_abs.READERS),
+                        help='also time parsing every table with these CSV readers')
+    parser.add_argument('--data-dir', help='keep the synthetic DataPacks here instead of a temporary directory')
+    parser.add_argument('--baseline', default='benchmark_baseline.json',
+                        help='baseline timings file (default: benchmark_baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these timings as the baseline instead of comparing against it')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown reported as a regression, as a fraction of the baseline (default: 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='slowdowns smaller than this are ignored as noise (default: 0.01)')
+    args = parser.parse_args(argv)
+
+    timings, areas = run_benchmarks(args.granularity, args.scale, args.repeat, args.data_dir,
+                                    readers=args.readers)
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print("%-4s %6s %8s  %-24s %10s %10s" % ('', 'scale', 'areas', 'stage', 'seconds', 'baseline'))
+    for key, elapsed in timings.items():
+        gran, scale, stage = key.split('/')
+        before = ('%10.4f' % baseline[key]) if key in baseline else '%10s' % '-'
+        print("%-4s %6s %8d  %-24s %10.4f %s" % (gran, scale, areas[gran + '/' + scale], stage, elapsed, before))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(timings, f, indent=1, sort_keys=True)
+        print("\nBaseline saved to", args.baseline)
+        return
+    regressions = compare(timings, baseline, args.threshold, args.min_seconds)
+    if regressions:
+        print("\nRegressions (more than %d%% slower than the baseline):" % (100 * args.threshold))
+        for key in regressions:
+            print("  %s %.4f s -> %.4f s" % (key, baseline[key], timings[key]))
+        sys.exit(1)
+    print("\nNo regressions" if baseline else "\nNo baseline to compare against; use --save-baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# Serves the features written by source_abs.py from memory, in-process or over HTTP
+
+import os
+import json
+import time
+import argparse
+import threading
+
+from source_abs import INDEX_CODES, read_features, feature_file
+
+"""Feature service
+
+Loads the features_by_<granularity> output of source_abs.py once per granularity into a
+column store indexed by geography code and answers single and batch lookups from it:
+
+    store = FeatureStore('~/', ['POA', 'SA2'])
+    store.get('POA', 'POA2000', ['population', 'median_age_persons'])
+    store.lookup('SA2', ['101021007', '101021008'])
+
+or over HTTP with python feature_service.py ~/ --port 8050:
+
+    GET  /features/POA/POA2000?columns=population,median_age_persons
+    GET  /features/POA?codes=POA2000,POA2001&columns=population
+    POST /features/POA   {"codes": ["POA2000", "POA2001"], "columns": ["population"]}
+    GET  /health
+
+A lookup answers {"features": {code: {column: value}}, "missing": [codes not found]}.
+The files are polled for changes; a new or rewritten file is loaded in the background and
+swapped in whole, so lookups never wait for a reload and never see half of one. The files of
+the latest build are loaded, in the fastest format it wrote: feather, parquet, npy, then csv.
+"""
+
+class FeatureTable:
+    # The features of one granularity: a hash index of the codes and one array per column.
+    # Never modified once built; a reload builds a new one.
+
+    def __init__(self, path):
+        import pandas as pd
+
+        # Modification time from before the read: a file replaced while it is read is loaded
+        # again on the next poll
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        df = read_features(path)
+        self.index = pd.Index(df.iloc[:, 0].astype(str))
+        self.columns = {}
+        for col in df.columns[1:]:
+            values = df[col]
+            if values.dtype == 'category' or values.dtype == object:
+                values = values.astype(object).where(values.notna(), None)
+            self.columns[col] = values.to_numpy()
+
+    def rows(self, codes, columns=None):
+        # Positions of codes (-1 when missing) and the selected columns
+        import numpy as np
+
+        if columns is None:
+            columns = list(self.columns)
+        unknown = [col for col in columns if col not in self.columns]
+        if unknown:
+            raise KeyError('Unknown column(s): ' + ', '.join(unknown))
+        return (np.asarray(self.index.get_indexer(codes)), columns)
+
+    def lookup(self, codes, columns=None):
+        # {'features': {code: {column: value}}, 'missing': [codes]}, with NaN as None
+        import numpy as np
+
+        codes = [str(code) for code in codes]
+        positions, columns = self.rows(codes, columns)
+        found = positions >= 0
+        picked = positions[found]
+        values = {}
+        for col in columns:
+            taken = self.columns[col][picked]
+            if taken.dtype.kind == 'f':
+                taken = np.where(np.isnan(taken), None, taken.astype(object))
+            values[col] = taken.tolist()
+
+        rows = zip(*[values[col] for col in columns])
+        found_codes = np.asarray(codes, dtype=object)[found]
+        features = {code: dict(zip(columns, row)) for code, row in zip(found_codes, rows)}
+        return ({'features': features, 'missing': [code for code, ok in zip(codes, found) if not ok]})
+
+    def frame(self, codes, columns=None):
+        # The same lookup as a DataFrame indexed by the codes found
+        import pandas as pd
+
+        codes = [str(code) for code in codes]
+        positions, columns = self.rows(codes, columns)
+        found = positions >= 0
+        picked = positions[found]
+        return (pd.DataFrame({col: self.columns[col][picked] for col in columns},
+                             index=pd.Index(self.index[picked], name=self.index.name)))
+
+
+class FeatureStore:
+    # Feature tables of several granularities, reloaded in the background when their files change
+
+    def __init__(self, datapack_dir, granularities=None, poll_seconds=None):
+        self.datapack_dir = datapack_dir
+        self.granularities = granularities or sorted(INDEX_CODES)
+        self.tables = {}
+        self.reload()
+        self.stop_polling = threading.Event()
+        if poll_seconds:
+            threading.Thread(target=self.poll, args=(poll_seconds,), daemon=True).start()
+
+    def reload(self):
+        # Loads every table whose file is new or changed; returns the granularities loaded
+        loaded = []
+        for gran in self.granularities:
+            path = feature_file(self.datapack_dir, gran)
+            current = self.tables.get(gran)
+            if path is None or (current and current.path == path and current.mtime == os.path.getmtime(path)):
+                continue
+            try:
+                table = FeatureTable(path)
+            except Exception as e:  # e.g. a file still being written; retried on the next poll
+                print("Could not load", path, ":", repr(e))
+                continue
+            self.tables[gran] = table  # a single assignment, readers see the old or the new table
+            loaded.append(gran)
+            print("Loaded", path, "(%d areas)" % len(table.index))
+        return (loaded)
+
+    def poll(self, poll_seconds):
+        while not self.stop_polling.wait(poll_seconds):
+            self.reload()
+
+    def table(self, granularity):
+        table = self.tables.get(granularity)
+        if table is None:
+            raise KeyError('No features loaded for ' + granularity)
+        return (table)
+
+    def get(self, granularity, code, columns=None):
+        # Features of one area as a dict, or None when the code is unknown
+        return (self.table(granularity).lookup([code], columns)['features'].get(str(code)))
+
+    def lookup(self, granularity, codes, columns=None):
+        return (self.table(granularity).lookup(codes, columns))
+
+    def frame(self, granularity, codes, columns=None):
+        return (self.table(granularity).frame(codes, columns))
+
+    def health(self):
+        return ({gran: {'path': table.path, 'areas': len(table.index), 'columns': len(table.columns),
+                        'modified': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(table.mtime))}
+                 for gran, table in self.tables.items()})
+
+
+def make_handler(store):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class FeatureHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def answer(self, parts, codes, columns):
+            try:
+                if parts == ['health']:
+                    self.send_json(200, store.health())
+                elif len(parts) == 3 and parts[0] == 'features':
+                    features = store.get(parts[1], parts[2], columns)
+                    if features is None:
+                        self.send_json(404, {'error': 'Unknown code ' + parts[2]})
+                    else:
+                        self.send_json(200, features)
+                elif len(parts) == 2 and parts[0] == 'features':
+                    self.send_json(200, store.lookup(parts[1], codes or [], columns))
+                else:
+                    self.send_json(404, {'error': 'Unknown path'})
+            except KeyError as e:
+                self.send_json(404, {'error': e.args[0]})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            codes = query['codes'][0].split(',') if 'codes' in query else None
+            columns = query['columns'][0].split(',') if 'columns' in query else None
+            self.answer([part for part in url.path.split('/') if part], codes, columns)
+
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            except ValueError:
+                self.send_json(400, {'error': 'Body is not JSON'})
+                return
+            if not isinstance(body, dict):
+                self.send_json(400, {'error': 'Body must be a JSON object'})
+                return
+            for key in ('codes', 'columns'):
+                value = body.get(key)
+                if value is not None and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+                    self.send_json(400, {'error': key + ' must be a list of strings'})
+                    return
+            parts = [part for part in urlparse(self.path).path.split('/') if part]
+            self.answer(parts, body.get('codes'), body.get('columns'))
+
+        def log_message(self, format, *args):
+            pass
+
+    return (FeatureHandler)
+
+
+def serve(store, host='127.0.0.1', port=8050):
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    print("Serving features on http://%s:%d" % (host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the features written by source_abs.py.')
+    parser.add_argument('datapack_dir', help='directory holding the features_by_<granularity> files')
+    parser.add_argument('--granularity', nargs='+', choices=sorted(INDEX_CODES),
+                        help='granularities to serve (default: all that have been built)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--poll', type=float, default=5,
+                        help='seconds between checks for new feature files (default: 5, 0 to disable)')
+    args = parser.parse_args(argv)
+
+    store = FeatureStore(args.datapack_dir, args.granularity, args.poll)
+    serve(store, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
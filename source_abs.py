@@ -3,17 +3,19 @@
 # Date: 16/03/2020
 
 import os
-import pandas as pd
-import numpy as np
 import time
 import pickle
 import sys
 import warnings
 import math
-from itertools import repeat
 import configparser
-
-warnings.filterwarnings("ignore")
+import zipfile
+import hashlib
+import threading
+import inspect
+import json
+import contextlib
+import tracemalloc
 
 """ABS Geographic Data Preparation
 
@@ -48,520 +50,2244 @@ Args:
     dir: Where the DataPack is stored on your device
         Needs to be formatted as '~/2016 Census GCP All Geographies for AUST/'+granularity+'/AUST/'
         where ~ is your working directory.
+
+    zip (optional): Path to '2016_GCP_ALL_for_AUS_short-header.zip'. When given, tables are
+        streamed straight out of the zip file and nothing needs to be unpacked. The features
+        file is still written to dir.
+
+    cache_dir (optional): Where parsed tables are cached between runs (default: dir + '.abs_cache').
+        Entries are keyed by source file path, size, modification time and the columns read,
+        so a changed DataPack is re-parsed automatically.
+
+    cache_size_mb (optional): Size limit of the cache; least recently used entries are evicted
+        first (default: 2048). Use --no-cache to bypass the cache and --clear-cache to empty it.
+
+    checkpoint_dir (optional): Where the output of every stage is checkpointed (default:
+        dir + '.abs_checkpoints'). A re-run only recomputes the stages whose source tables or code
+        changed; --force <stage> recomputes a stage regardless and --no-checkpoint disables this.
+
+Batch mode:
+    Several granularities can be built in one run, each in its own worker process:
+
+        python source_abs.py --granularity POA SA1 SA2 SA3 SA4 SSC --jobs 4
+
+    The index_code of each granularity is looked up in INDEX_CODES; the config file
+    only needs to provide dir. Without --granularity the config file values are used.
+
+Library use:
+    Importing the module has no side effects and does not import pandas; the parameters
+    above are passed to build_features(), which returns the features as a DataFrame:
+
+        from source_abs import build_features
+        df = build_features('POA', '~/', zip_path='~/2016_GCP_ALL_for_AUS_short-header.zip')
+
+    Each stage (Load_wkly_prsnl_inc, Load_median_data, ...) can also be called on its own
+    with a DataPack and returns a DataFrame indexed by geography code.
+
+Memory:
+    build_features() and build_rollup() return their frames with compact dtypes (integer or Arrow
+    string geography codes, categorical interval labels, downcast counts, float32 ratios) to keep
+    several granularities resident at once; pass compact=False for the full-width frame. The
+    command line keeps full width unless --compact is given, so its csv output is unchanged.
+
+Readers:
+    --reader arrow parses the tables with pyarrow's multithreaded CSV reader instead of the
+    single-threaded pandas C parser; --reader arrow_dtypes also keeps the geography codes as
+    Arrow strings instead of converting them to Python objects. All readers give the same
+    columns, codes and numeric dtypes. benchmark_abs.py --readers compares them table by table.
+
+Key checks and filters:
+    Before the tables are joined their geography codes are checked: a code appearing twice in
+    a table is an error, and codes missing from some of the tables are reported (a 'validation'
+    event). --filters picks the ROW_FILTERS whose areas are dropped from the features
+    (default: zero_population; --filters with no names keeps every area).
+
+Census years:
+    Tables and columns are named as in the 2016 DataPack. A census spec (see census_2016.ini)
+    gives the folder, file names and index codes of another year's DataPack and maps the 2016
+    table and column names, and income bins where they differ, to its own, so that it gives the
+    same features. census_2011.ini (Basic Community Profile) and census_2021.ini (General
+    Community Profile) are shipped next to census_2016.ini. --panel builds
+    several years, each in its own worker process, into one features_by_<granularity>_panel
+    file keyed by geography code and year (--panel-layout wide: one column per feature and year):
+
+        python source_abs.py --panel census_2011.ini census_2016.ini census_2021.ini
+
+    Each table of a year is parsed once, even when several 2016 tables map to it.
+
+Neighbourhoods:
+    Given the centroids of the areas (a csv of code, latitude and longitude, or an ASGS
+    boundary file with geopandas installed), smoothed features are appended: the population
+    weighted average of each feature over the k nearest areas and over the areas within a
+    radius. The centroids go into a KD-tree (scipy) once and all areas are queried in batches:
+
+        python source_abs.py --centroids POA_centroids.csv --knn 10 --radius-km 5
+
+Output formats:
+    --format csv parquet feather npy writes the features in any of these formats next to the
+    DataPack. Parquet and Feather keep the column types (including the categorical interval
+    labels) and need pyarrow; npy writes a memory-mappable float64 matrix with the geography
+    codes and a typed schema alongside. read_features() loads any of them, optionally only
+    some of the columns.
+
+Streaming:
+    With --stream all tables are read side by side in chunks of --chunk-rows areas and the
+    features of each chunk are appended to the output file, so memory use stays flat however
+    many areas the granularity has. Use it for SA1 on machines with little memory.
+
+Feature specs:
+    Features can be declared in an INI file instead of code: every section names the table(s)
+    it reads, the columns and a transform (rename, ratio, scale, interval or binned_stats).
+    The planner reads each table once with the union of the columns all sections need:
+
+        python source_abs.py --features features.ini
+
+    features.ini gives the same features as the built-in stages; copy and extend it.
+
+Instrumentation:
+    Every stage, table read and checkpoint load emits an event: a dict with its wall and CPU
+    time, rows in and out, bytes read and memory peaks. Warnings are reported as events too.
+    add_event_sink(callback) receives them in-process; --events <file> (or events= in
+    build_features) appends them as JSON lines, --profile-dir <dir> writes a cProfile dump
+    per stage and --trace-memory adds the tracemalloc peak of each, above the memory traced
+    when it started.
+
+Similar areas:
+    similar_areas() finds the k areas most like given ones by cosine similarity (or euclidean
+    distance) of the standardised normalised features (std_norm_*, mean_norm_*, *_standardised,
+    pct_*), searching the whole granularity in blocks of matrix products. For SA1,
+    build_similarity_index() clusters the areas so a query only searches the nearest clusters.
+
+        python source_abs.py similar POA2000 POA3000 --level POA -k 5
+        python source_abs.py similar 1100701 --level SA1 --index sa1_index.npz
+
+Feature service:
+    feature_service.py keeps the features of every granularity in memory, indexed by code, and
+    answers single and batch lookups in-process or over HTTP, reloading files as they change.
+
+Benchmarks:
+    synthetic_datapack.py writes a synthetic DataPack of any size with the tables and columns
+    read here; benchmark_abs.py times every stage on such DataPacks and flags regressions
+    against stored baseline timings.
+
+Roll-up:
+    SA2, SA3 and SA4 can be derived from a single read of the SA1 DataPack by summing its counts
+    up the ASGS hierarchy:
+
+        python source_abs.py --rollup SA2 SA3 SA4 --concordance SA1_2016_AUST.csv
+
+    The concordance is the ASGS SA1 allocation file; it is needed because the DataPack's 7-digit
+    SA1 codes do not contain the SA3/SA4 codes. Income medians are re-derived from the summed
+    income bins; the other G02 medians and averages are population-weighted approximations.
 """
 
+# First column of every DataPack table at each geographic level
+INDEX_CODES = {'POA': 'POA_CODE_2016',
+               'SA1': 'SA1_7DIGITCODE_2016',
+               'SA2': 'SA2_MAINCODE_2016',
+               'SA3': 'SA3_CODE_2016',
+               'SA4': 'SA4_CODE_2016',
+               'SSC': 'SSC_CODE_2016'}
+
+# Where a Census DataPack keeps its tables and what they are called. Every table and column
+# named in this script is a 2016 one; a census spec (see read_census_spec) maps them to those
+# of another Census, so that every year gives the same features.
+CENSUS_2016 = {'year': '2016',
+               'path': '{year} Census GCP All Geographies for AUST/{granularity}/AUST/',
+               'file': '{year}Census_{table}_AUS_{granularity}.csv',
+               'dir': '', 'zip': '', 'granularities': {}, 'index_codes': INDEX_CODES, 'tables': {}, 'columns': {},
+               'bins': {}}
+
+
 #=======================================================================
 #PARAMATERS from config file
 #=======================================================================
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-granularity = config.get('parameters','granularity')
-index_code = config['parameters']['index_code']
-directory = config['parameters']['dir']
-dir = directory + '2016 Census GCP All Geographies for AUST/'+granularity+'/AUST/'
+def read_config(path='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(path)
+    params = config['parameters'] if config.has_section('parameters') else {}
+    return ({'granularity': params.get('granularity'),
+             'index_code': params.get('index_code'),
+             'datapack_dir': params.get('dir', ''),
+             'zip_path': params.get('zip', ''),
+             'cache_dir': params.get('cache_dir'),
+             'cache_size_mb': float(params.get('cache_size_mb', 2048)),
+             'checkpoint_dir': params.get('checkpoint_dir')})
+
+
+def read_census_spec(path):
+    # Reads a census spec (see census_2016.ini) into a dict like CENSUS_2016. Index codes not
+    # given are the 2016 ones with the year replaced; tables and columns not mapped keep their
+    # 2016 names. A column may map to several, which are added up. Binned sources whose bins
+    # differ from 2016's (see BIN_SPECS) are given their own, one row per line.
+    config = configparser.ConfigParser(interpolation=None)
+    config.optionxform = str  # table and column names are case sensitive
+    if not config.read(path):
+        raise FileNotFoundError('Census spec not found: ' + path)
+    if not config.has_option('census', 'year'):
+        raise ValueError('[census] of ' + path + ' has no year')
+
+    census = dict(CENSUS_2016, **{key: value for key, value in config['census'].items()
+                                  if key in ('year', 'path', 'file', 'dir', 'zip')})
+    sections = {name: dict(config[name]) if config.has_section(name) else {}
+                for name in ('granularities', 'index_codes', 'tables', 'columns', 'bins')}
+    unknown = set(sections['granularities']) | set(sections['index_codes'])
+    unknown -= set(INDEX_CODES)
+    if unknown:
+        raise ValueError('Unknown granularities in ' + path + ': ' + ', '.join(sorted(unknown)))
+    census['granularities'] = sections['granularities']
+    census['index_codes'] = {gran: sections['index_codes'].get(gran, code.replace('_2016', '_' + census['year']))
+                             for gran, code in INDEX_CODES.items()}
+    for table, mapped in sections['tables'].items():
+        if len(mapped.split()) != 1:
+            raise ValueError('[tables] of ' + path + ' must map ' + table + ' to a single table')
+    census['tables'] = {table: mapped.strip() for table, mapped in sections['tables'].items()}
+    census['columns'] = {col: names.split() for col, names in sections['columns'].items()}
+    census['bins'] = {}
+    for name, lines in sections['bins'].items():
+        if name not in BIN_SPECS:
+            raise ValueError('[bins] of ' + path + ' must be one of ' + ', '.join(BIN_SPECS) + ', not ' + name)
+        rows = [line.split() for line in lines.splitlines() if line.strip()]
+        try:
+            spec = [(col, label, int(lower), int(value), int(midpoint)) for col, label, lower, value, midpoint in rows]
+        except ValueError:
+            raise ValueError('[bins] ' + name + ' of ' + path + ' needs lines of: column label lower value midpoint')
+        lower = [row[2] for row in spec]
+        if not spec or lower != sorted(set(lower)):
+            raise ValueError('[bins] ' + name + ' of ' + path + ' needs bins in increasing order of their lower edge')
+        census['bins'][name] = spec
+    return (census)
 
 
 #=======================================================================
-#FUNCTIONS
+#INSTRUMENTATION
 #=======================================================================
+# Callables receiving every event as a dict; see add_event_sink
+EVENT_SINKS = []
+event_state = threading.local()
+
+
+class JsonLinesSink:
+    # Appends every event as one line of JSON to path. Lines are written in a single call on a
+    # file opened for appending, so several processes can share the file.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+def add_event_sink(sink):
+    EVENT_SINKS.append(sink)
+    return (sink)
+
+
+def remove_event_sink(sink):
+    if sink in EVENT_SINKS:
+        EVENT_SINKS.remove(sink)
+
+
+def emit_event(event):
+    if not EVENT_SINKS:
+        return
+    event.update({'time': time.time(), 'pid': os.getpid(), 'thread': threading.current_thread().name})
+    for sink in list(EVENT_SINKS):
+        sink(event)
+
+
+def max_rss_mb():
+    # Peak resident memory of the process so far, where the platform reports it
+    try:
+        import resource
+    except ImportError:
+        return (None)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10)
+
+
+@contextlib.contextmanager
+def measured(kind, name, granularity, profile_dir=None):
+    # Emits an event with the wall and CPU time of the block, the memory peaks and what the block
+    # fills in (rows_in, rows_out, bytes_read, ...). Rows and bytes of reads inside the block are
+    # added to its rows_in and bytes_read. CPU time is that of the current thread. When tracing,
+    # traced_peak_mb is the peak of traced memory during the block above what was traced when it
+    # started; tracemalloc is process-wide, so it includes stages running at the same time.
+    event = {'event': kind, 'name': name, 'granularity': granularity, 'rows_in': 0, 'rows_out': None,
+             'bytes_read': 0}
+    outer = getattr(event_state, 'event', None)
+    event_state.event = event
+    profiler = None
+    if profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # Blocks reset the peak, so each passes the highest it saw up to the block around it
+        traced, peak = tracemalloc.get_traced_memory()
+        outer_peak = max(getattr(event_state, 'traced_peak', 0), peak)
+        event_state.traced_peak = 0
+        tracemalloc.reset_peak()
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield event
+    except BaseException as e:
+        event['error'] = repr(e)
+        raise
+    finally:
+        event['wall_s'] = time.perf_counter() - wall
+        event['cpu_s'] = time.thread_time() - cpu
+        if tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], event_state.traced_peak)
+            event['traced_peak_mb'] = max(peak - traced, 0) / 2 ** 20
+            event_state.traced_peak = max(outer_peak, peak)
+        event['max_rss_mb'] = max_rss_mb()
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            event['profile'] = os.path.join(profile_dir, granularity + '_' + name + '.prof')
+            profiler.dump_stats(event['profile'])
+        event_state.event = outer
+        if outer is not None:
+            outer['rows_in'] += event['rows_out'] or 0
+            outer['bytes_read'] += event['bytes_read']
+        emit_event(event)
+
+
+show_warning = warnings.showwarning
+
+
+def warning_event(message, category, filename, lineno, file=None, line=None):
+    # Reports a warning as an event, with the stage or read it was raised in, then shows it as usual
+    current = getattr(event_state, 'event', None)
+    emit_event({'event': 'warning', 'name': category.__name__, 'message': str(message),
+                'location': filename + ':' + str(lineno), 'during': current and current['name']})
+    show_warning(message, category, filename, lineno, file, line)
+
+
+def capture_warnings():
+    # Warnings (e.g. pandas' SettingWithCopyWarning, which points at hidden copies) are shown
+    # once per location and reported as events
+    warnings.simplefilter('default')
+    warnings.showwarning = warning_event
 
-def snip(name):
-    new = name[2:-4]
-    return (new)
-
-def median_range(val):
-    if val == 0:
-        return ('Neg_Nil_income')
-    elif val >= 1 and val < 150:
-        return ('1_149')
-    elif val >= 150 and val < 300:
-        return ('150_299')
-    elif val >= 300 and val < 400:
-        return ('300_399')
-    elif val >= 400 and val < 500:
-        return ('400_499')
-    elif val >= 500 and val < 650:
-        return ('500_649')
-    elif val >= 650 and val < 800:
-        return ('650_799')
-    elif val >= 800 and val < 1000:
-        return ('800_999')
-    elif val >= 1000 and val < 1250:
-        return ('1000_1249')
-    elif val >= 1250 and val < 1500:
-        return ('1250_1499')
-    elif val >= 1500 and val < 1750:
-        return ('1500_1749')
-    elif val >= 1750 and val < 2000:
-        return ('1750_1999')
-    elif val >= 2000 and val < 3000:
-        return ('2000_2999')
-    else:
-        return ('3000_more')
-
-
-def get_int_vals(df,geolevel):
-    lst = []
-    for i in df.index.tolist()[1:]:
-        upper_val = toint(i)
-        pos = df.index.tolist()[1:].index(i)
-        freq = df[geolevel].tolist()[1:][pos]
-        lst.extend(repeat(upper_val, freq))
-    return (lst)
-
-
-def toint(str):
-    if str == 'Neg_Nil_income':
-        return (0)
-    elif str == '1_149':
-        return (75)
-    elif str == '150_299':
-        return (225)
-    elif str == '300_399':
-        return (350)
-    elif str == '400_499':
-        return (450)
-    elif str == '500_649':
-        return (575)
-    elif str == '650_799':
-        return (625)
-    elif str == '800_999':
-        return (850)
-    elif str == '1000_1249':
-        return (1125)
-    elif str == '1250_1499':
-        return (1375)
-    elif str == '1500_1749':
-        return (1625)
-    elif str == '1750_1999':
-        return (1875)
-    elif str == '2000_2999':
-        return (2500)
-    else:
-        return (3000)
-
-
-def summary(df,geolevel):
-    int_lst = get_int_vals(df,geolevel)
-    info = pd.Series(int_lst).describe()
-    se = pd.Series(get_int_vals(df,geolevel))
-    se = (se - se.min()) / ((se.max() - se.min()))
-    info_norm = se.describe()
-    return (info, info_norm)
-
-
-def get_str_vals_HI(df,geolevel):
-    lst = []
-    for i in df.index.tolist()[1:]:
-        pos = df.index.tolist()[1:].index(i)
-        freq = df[geolevel].tolist()[1:][pos]
-        lst.extend(repeat(i, freq))
-    return (lst)
-
-
-def get_int_vals_HI(df,geolevel):
-    lst = []
-    for i in df.index.tolist()[1:]:
-        upper_val = toint_HI(i)
-        pos = df.index.tolist()[1:].index(i)
-        freq = df[geolevel].tolist()[1:][pos]
-        lst.extend(repeat(upper_val, freq))
-    return (lst)
-
-
-def toint_HI(str):
-    if str == 'Negative_Nil_income_Tot':
-        return (0)
-    elif str == 'HI_1_149_Tot':
-        return (75)
-    elif str == 'HI_150_299_Tot':
-        return (225)
-    elif str == 'HI_300_399_Tot':
-        return (350)
-    elif str == 'HI_400_499_Tot':
-        return (450)
-    elif str == 'HI_500_649_Tot':
-        return (575)
-    elif str == 'HI_650_799_Tot':
-        return (625)
-    elif str == 'HI_800_999_Tot':
-        return (850)
-    elif str == 'HI_1000_1249_Tot':
-        return (1125)
-    elif str == 'HI_1250_1499_Tot':
-        return (1375)
-    elif str == 'HI_1500_1749_Tot':
-        return (1625)
-    elif str == 'HI_1750_1999_Tot':
-        return (1875)
-    elif str == 'HI_2000_2499_Tot':
-        return (2250)
-    elif str == 'HI_2500_2999_Tot':
-        return (2750)
-    elif str == 'HI_3000_3499_Tot':
-        return (3250)
-    elif str == 'HI_3500_3999_Tot':
-        return (3750)
-    else:
-        return (4000)
-
-
-def median_range_HI(val):
-    if val == 0:
-        return ('Negative_Nil_income_Tot')
-    elif val >= 1 and val < 150:
-        return ('HI_1_149_Tot')
-    elif val >= 150 and val < 300:
-        return ('HI_150_299_Tot')
-    elif val >= 300 and val < 400:
-        return ('HI_300_399_Tot')
-    elif val >= 400 and val < 500:
-        return ('HI_400_499_Tot')
-    elif val >= 500 and val < 650:
-        return ('HI_500_649_Tot')
-    elif val >= 650 and val < 800:
-        return ('HI_650_799_Tot')
-    elif val >= 800 and val < 1000:
-        return ('HI_800_999_Tot')
-    elif val >= 1000 and val < 1250:
-        return ('HI_1000_1249_Tot')
-    elif val >= 1250 and val < 1500:
-        return ('HI_1250_1499_Tot')
-    elif val >= 1500 and val < 1750:
-        return ('HI_1500_1749_Tot')
-    elif val >= 1750 and val < 2000:
-        return ('HI_1750_1999_Tot')
-    elif val >= 2000 and val < 2500:
-        return ('HI_2000_2499_Tot')
-    elif val >= 2500 and val < 3000:
-        return ('HI_2500_2999_Tot')
-    elif val >= 3000 and val < 3500:
-        return ('HI_3000_3499_Tot')
-    elif val >= 3500 and val < 4000:
-        return ('HI_3500_3999_Tot')
-    else:
-        return ('HI_4000_more_Tot')
 
+#=======================================================================
+#FUNCTIONS
+#=======================================================================
 
-def summary_HI(df,geolevel):
-    int_lst = get_int_vals_HI(df,geolevel)
-    info = pd.Series(int_lst).describe()
-    se = pd.Series(get_int_vals_HI(df,geolevel))
-    se = (se - se.min()) / ((se.max() - se.min()))
-    info_norm = se.describe()
-    return (info, info_norm)
+class DataPack:
+    # Where one granularity of a DataPack is read from, and how its parsed tables are cached.
+    # Tables parsed through a DataPack are kept for its lifetime; stages run in threads, so each
+    # table has a lock making concurrent readers wait for a single parse. census (default
+    # CENSUS_2016) gives the layout of the DataPack and the names of its tables and columns;
+    # tables and columns are always asked for by their 2016 names.
+
+    def __init__(self, granularity, datapack_dir, index_code=None, zip_path='', cache_dir=None,
+                 cache=True, cache_size_mb=2048, reader='c', filters=None, census=None):
+        self.census = census or CENSUS_2016
+        self.granularity = granularity
+        self.area = self.census['granularities'].get(granularity, granularity)  # as named in the file names
+        self.index_code = index_code or self.census['index_codes'][granularity]
+        self.datapack_dir = datapack_dir
+        self.dir = os.path.join(datapack_dir, self.census['path'].format(year=self.census['year'],
+                                                                         granularity=self.area), '')
+        self.zip_path = zip_path
+        self.cache_dir = cache_dir or os.path.join(datapack_dir, '.abs_cache')
+        self.cache = cache
+        self.cache_size_mb = cache_size_mb
+        self.reader = reader
+        self.filters = DEFAULT_FILTERS if filters is None else tuple(filters)
+        self.source_codes = {}  # codes of every source read, for check_keys
+        self.planned_reads = {}  # columns read from each table of the census, see plan_reads
+        self.parsed_tables = {}
+        self.parsed_table_locks = {}
+        self.lock = threading.Lock()
+
+    def file_name(self, table):
+        return (self.census['file'].format(year=self.census['year'], table=self.census['tables'].get(table, table),
+                                           granularity=self.area))
+
+    def source(self, table):
+        # (file to open, zip member or '') of a table
+        if self.zip_path:
+            return (self.zip_path, self.file_name(table))
+        return (self.dir + self.file_name(table), '')
+
+    def read_table(self, tables, cols, dtypes=None):
+        # Reads only the index column and cols from one DataPack table, or from several parts of
+        # a table (e.g. G17A/G17B/G17C) placed side by side. dtypes is a single dtype for all of
+        # cols or a dict by column; the geography code is always read as a string.
+        if isinstance(tables, str):
+            tables = [tables]
+        wanted, dtype = self.column_spec(cols, dtypes)
+
+        parts = [self.read_columns(table, wanted, dtype) for table in tables]
+
+        return (combine_parts(parts, self.index_code, cols, tables))
+
+    def column_spec(self, cols, dtypes=None):
+        # Columns to parse and their dtypes
+        wanted = set([self.index_code] + cols)
+        dtype = {self.index_code: str}
+        if isinstance(dtypes, dict):
+            dtype.update(dtypes)
+        elif dtypes is not None:
+            dtype.update({col: dtypes for col in cols})
+        return (wanted, dtype)
+
+    def read_indexed(self, tables, cols, dtypes=None):
+        # Every stage works on frames indexed by the geography code
+        df = self.read_table(tables, cols, dtypes)
+        df = df.set_index(self.index_code)
+        df.index.name = 'GeoLevel'
+        return (df)
+
+    def bins(self, name):
+        # Bins of a binned source in this census
+        return (self.census['bins'].get(name, BIN_SPECS[name]))
+
+    def source_spec(self, name):
+        # Tables, columns and dtypes of a source (see SOURCES), with the bins of this census
+        tables, cols, dtypes = SOURCES[name]
+        if name in self.census['bins']:
+            cols = bin_columns(self.census['bins'][name])
+        return (tables, cols, dtypes)
+
+    def read_source(self, name):
+        tables, cols, dtypes = self.source_spec(name)
+        df = self.read_indexed(tables, cols, dtypes)
+        self.source_codes[name] = df.index
+        return (df)
+
+    def census_columns(self, col):
+        # Columns of the census a 2016 column is read from (added up when several)
+        if col == self.index_code:
+            return ([col])
+        return (self.census['columns'].get(col, [col]))
+
+    def census_reads(self, wanted, dtype):
+        # Columns of the census read for the wanted 2016 columns, and their dtypes
+        read_wanted, read_dtype = set(), {}
+        for col in wanted:
+            for name in self.census_columns(col):
+                read_wanted.add(name)
+                if col in dtype:
+                    read_dtype[name] = dtype[col]
+        return (read_wanted, read_dtype)
+
+    def plan_reads(self, reads):
+        # reads lists (2016 table, wanted, dtype) as from column_spec. Every table of the census is
+        # then parsed once, with the columns all of them need, however many 2016 tables map to it.
+        for table, wanted, dtype in reads:
+            read_wanted, read_dtype = self.census_reads(wanted, dtype)
+            planned_wanted, planned_dtype = self.planned_reads.setdefault(self.census['tables'].get(table, table),
+                                                                         (set(), {}))
+            planned_wanted.update(read_wanted)
+            planned_dtype.update(read_dtype)
+
+    def read_columns(self, table, wanted, dtype):
+        # Reads a table with the wanted columns under their 2016 names. A planned table is parsed
+        # with all the columns planned for it, so columns of other tables may come along.
+        import pandas as pd
+
+        source, member = self.source(table)
+        read_wanted, read_dtype = self.census_reads(wanted, dtype)
+        planned = self.planned_reads.get(self.census['tables'].get(table, table))
+        if planned and read_wanted <= planned[0]:
+            read_wanted, read_dtype = planned
+        df = self.read_part(source, member, read_wanted, read_dtype)
+        if not self.census['columns']:
+            return (df)
+
+        columns = {col: df[col] for col in df.columns if col not in self.census['columns']}
+        for col, names in self.census['columns'].items():
+            if col in wanted and all(name in df.columns for name in names):
+                columns[col] = df[names[0]] if len(names) == 1 else df[names].sum(axis=1)
+        return (pd.DataFrame(columns))
+
+    def read_part(self, source, member, wanted, dtype):
+        # Parsed tables are reused within a run and, unless disabled, cached on disk across runs
+        key = cache_key(source, member, wanted, dtype, self.reader)
+        with measured('read', member or os.path.basename(source), self.granularity) as event:
+            with self.lock:
+                lock = self.parsed_table_locks.setdefault(key, threading.Lock())
+            with lock:
+                event['origin'] = 'memory'
+                if key not in self.parsed_tables:
+                    self.parsed_tables[key] = self.load_part(key, source, member, wanted, dtype, event)
+            event['rows_out'] = len(self.parsed_tables[key])
+        return (self.parsed_tables[key])
+
+    def load_part(self, key, source, member, wanted, dtype, event=None):
+        event = {} if event is None else event
+        cache_file = os.path.join(self.cache_dir, key + '.pkl')
+        if self.cache and os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                df = pickle.load(f)
+            os.utime(cache_file)
+            event.update({'origin': 'cache', 'bytes_read': os.path.getsize(cache_file)})
+        else:
+            df = parse_part(source, member, self.area, wanted, dtype, self.reader)
+            event.update({'origin': 'source', 'reader': self.reader, 'bytes_read': part_size(source, member, self.area)})
+            if self.cache:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_file = cache_file + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+                with open(tmp_file, 'wb') as f:
+                    pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, cache_file)
+                trim_cache(self.cache_dir, self.cache_size_mb)
+        return (df)
+
+
+def zip_member(zf, name, granularity):
+    # DataPack zips nest every table in a '<...>/<granularity>/<...>/' folder
+    for member in zf.namelist():
+        if (member.endswith('/' + name) and '/' + granularity + '/' in member) or member == name:
+            return (member)
+    raise KeyError(name + ' not found in ' + zf.filename)
+
+
+def open_part(source, member, granularity):
+    # File object of a table, streamed out of the zip when a member is given
+    if member:
+        zf = zipfile.ZipFile(source)
+        f = zf.open(zip_member(zf, member, granularity))
+        zf.close()  # the member stays readable until it is closed itself
+        return (f)
+    return (open(source, 'rb'))
+
+
+def read_csv_c(f, wanted, dtype):
+    import pandas as pd
+
+    return (pd.read_csv(f, usecols=lambda c: c in wanted, dtype=dtype))
+
+
+def read_csv_arrow(f, wanted, dtype, arrow_dtypes=False):
+    # Multithreaded Arrow CSV parser. The header is read here so that only the wanted columns
+    # present in this table are converted, in file order like the C parser; dtype is enforced
+    # while parsing. arrow_dtypes keeps string columns (the geography codes) in their Arrow
+    # buffers as pd.ArrowDtype instead of converting them to Python objects. Numeric columns
+    # are always handed over as NumPy (without a copy when they have no missing values), so the
+    # stages compute with NumPy semantics whatever the reader.
+    import csv
+    import numpy as np
+    import pandas as pd
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+    except ImportError:
+        raise ImportError('pyarrow is required for the arrow readers')
+
+    header = next(csv.reader([f.readline().decode('utf-8-sig')]))
+    present = [col for col in header if col in wanted]
+    types = {col: pa.string() if t is str else pa.from_numpy_dtype(np.dtype(t))
+             for col, t in dtype.items() if col in present}
+    table = pacsv.read_csv(f, read_options=pacsv.ReadOptions(column_names=header, use_threads=True),
+                           convert_options=pacsv.ConvertOptions(include_columns=present, column_types=types))
+    if arrow_dtypes:
+        return (table.to_pandas(types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_string(t) else None))
+    return (table.to_pandas())
+
+
+# CSV parsers a DataPack can read its tables with. All of them read the same columns, in the
+# same order, with the geography code as strings and the dtypes asked for.
+READERS = {'c': read_csv_c,
+           'arrow': read_csv_arrow,
+           'arrow_dtypes': lambda f, wanted, dtype: read_csv_arrow(f, wanted, dtype, arrow_dtypes=True)}
+
+
+def parse_part(source, member, granularity, wanted, dtype, reader='c'):
+    if reader not in READERS:
+        raise ValueError('Unknown reader ' + reader + '; choose from ' + ', '.join(READERS))
+    with open_part(source, member, granularity) as f:
+        return (READERS[reader](f, wanted, dtype))
+
+
+def part_size(source, member, granularity):
+    # Bytes of a table as stored in the DataPack (uncompressed for zip members)
+    if member:
+        with zipfile.ZipFile(source) as zf:
+            return (zf.getinfo(zip_member(zf, member, granularity)).file_size)
+    return (os.path.getsize(source))
+
+
+def combine_parts(parts, index_code, cols, tables):
+    # Places the parts of a table side by side, matched on the geography code, and keeps the
+    # index column and cols. Areas missing from a part are reported and left out.
+    import pandas as pd
+
+    parts = [part.set_index(index_code) for part in parts]
+    if any(not part.index.equals(parts[0].index) for part in parts[1:]):
+        check_keys({table: part.index for table, part in zip(tables, parts)})
+    df = pd.concat(parts, axis=1, join='inner').reset_index()
+    df = df.loc[:, ~df.columns.duplicated()]
+    missing = [col for col in cols if col not in df.columns]
+    if missing:
+        raise KeyError('Columns missing from ' + '/'.join(tables) + ': ' + ', '.join(missing))
+    return (df[[index_code] + cols])
+
+
+def cache_key(source, member, wanted, dtype, reader='c'):
+    # Tables read as Arrow dtypes are cached apart; the other readers give the same frame
+    st = os.stat(source)
+    key = (os.path.abspath(source), member, st.st_size, st.st_mtime_ns,
+           sorted(wanted), sorted((col, str(t)) for col, t in dtype.items()))
+    if reader == 'arrow_dtypes':
+        key += (reader,)
+    return (hashlib.sha1(repr(key).encode()).hexdigest())
+
+
+def trim_cache(cache_dir, cache_size_mb):
+    # Evicts the least recently used entries until the cache fits in cache_size_mb
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(e[1] for e in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= cache_size_mb * 1024 * 1024:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear_cache(cache_dir):
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pkl') or name.endswith('.tmp'):
+                os.remove(os.path.join(cache_dir, name))
+
+
+# Binned Census distributions, one row per bin: DataPack column, interval label, lower edge of
+# the interval, the value that stands for the bin in the binned mean and std (kept as in the
+# original script, even where it is not central, e.g. 625 for 650_799) and the midpoint of the
+# bin (the lower edge for the open top bin). A value falls in the last bin whose lower edge it
+# reaches.
+PERSONAL_INCOME_BINS = [('P_Neg_Nil_income_Tot', 'Neg_Nil_income', 0, 0, 0),
+                        ('P_1_149_Tot', '1_149', 1, 75, 75),
+                        ('P_150_299_Tot', '150_299', 150, 225, 225),
+                        ('P_300_399_Tot', '300_399', 300, 350, 350),
+                        ('P_400_499_Tot', '400_499', 400, 450, 450),
+                        ('P_500_649_Tot', '500_649', 500, 575, 575),
+                        ('P_650_799_Tot', '650_799', 650, 625, 725),
+                        ('P_800_999_Tot', '800_999', 800, 850, 900),
+                        ('P_1000_1249_Tot', '1000_1249', 1000, 1125, 1125),
+                        ('P_1250_1499_Tot', '1250_1499', 1250, 1375, 1375),
+                        ('P_1500_1749_Tot', '1500_1749', 1500, 1625, 1625),
+                        ('P_1750_1999_Tot', '1750_1999', 1750, 1875, 1875),
+                        ('P_2000_2999_Tot', '2000_2999', 2000, 2500, 2500),
+                        ('P_3000_more_Tot', '3000_more', 3000, 3000, 3000)]  # 'P_PI_NS_ns_Tot' - Personal Income not stated col
+
+HOUSEHOLD_INCOME_BINS = [('Negative_Nil_income_Tot', 'Negative_Nil_income_Tot', 0, 0, 0),
+                         ('HI_1_149_Tot', 'HI_1_149_Tot', 1, 75, 75),
+                         ('HI_150_299_Tot', 'HI_150_299_Tot', 150, 225, 225),
+                         ('HI_300_399_Tot', 'HI_300_399_Tot', 300, 350, 350),
+                         ('HI_400_499_Tot', 'HI_400_499_Tot', 400, 450, 450),
+                         ('HI_500_649_Tot', 'HI_500_649_Tot', 500, 575, 575),
+                         ('HI_650_799_Tot', 'HI_650_799_Tot', 650, 625, 725),
+                         ('HI_800_999_Tot', 'HI_800_999_Tot', 800, 850, 900),
+                         ('HI_1000_1249_Tot', 'HI_1000_1249_Tot', 1000, 1125, 1125),
+                         ('HI_1250_1499_Tot', 'HI_1250_1499_Tot', 1250, 1375, 1375),
+                         ('HI_1500_1749_Tot', 'HI_1500_1749_Tot', 1500, 1625, 1625),
+                         ('HI_1750_1999_Tot', 'HI_1750_1999_Tot', 1750, 1875, 1875),
+                         ('HI_2000_2499_Tot', 'HI_2000_2499_Tot', 2000, 2250, 2250),
+                         ('HI_2500_2999_Tot', 'HI_2500_2999_Tot', 2500, 2750, 2750),
+                         ('HI_3000_3499_Tot', 'HI_3000_3499_Tot', 3000, 3250, 3250),
+                         ('HI_3500_3999_Tot', 'HI_3500_3999_Tot', 3500, 3750, 3750),
+                         ('HI_4000_more_Tot', 'HI_4000_more_Tot', 4000, 4000, 4000)]  # 'HI_PI_NS_Tot' - not stated col
+
+# Bins of every binned source, by name; a census spec may give a year's own (see read_census_spec)
+BIN_SPECS = {'personal_income': PERSONAL_INCOME_BINS,
+             'household_income': HOUSEHOLD_INCOME_BINS}
+
+
+def bin_columns(spec):
+    return ([row[0] for row in spec])
+
+
+def bin_values(spec):
+    return ([row[3] for row in spec])
+
+
+def bin_midpoints(spec):
+    return ([row[4] for row in spec])
+
+
+def bin_labels(values, spec):
+    # Interval label of every value as an ordered categorical, in one searchsorted pass.
+    # Missing values and values below the first edge get no label.
+    import numpy as np
+    import pandas as pd
+
+    x = np.asarray(values, dtype=float)
+    codes = np.searchsorted([row[2] for row in spec], x, side='right') - 1
+    codes[np.isnan(x)] = -1
+    labels = pd.Categorical.from_codes(codes, categories=[row[1] for row in spec], ordered=True)
+    return (pd.Series(labels, index=getattr(values, 'index', None)))
+
+
+def binned_summary(counts, values):
+    # Weighted statistics of binned person/household counts for every area at once.
+    # counts: DataFrame (areas x bins), values: representative value of each bin.
+    # Equivalent to expanding each area into one value per person and calling describe(),
+    # i.e. sample std (ddof=1) and min-max normalisation over the bins that are populated.
+    import numpy as np
+    import pandas as pd
+
+    c = np.clip(counts.to_numpy(dtype=float), 0, None)
+    v = np.asarray(values, dtype=float)
+
+    n = c.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (c @ v) / n
+        std = np.sqrt((c * (v - mean[:, None]) ** 2).sum(axis=1) / (n - 1))
+        std[n <= 1] = np.nan
+
+        populated = c > 0
+        v_min = np.where(populated, v, np.inf).min(axis=1)
+        v_max = np.where(populated, v, -np.inf).max(axis=1)
+        spread = v_max - v_min
+        std_norm = np.where(spread > 0, std / spread, np.nan)
+        mean_norm = np.where(spread > 0, (mean - v_min) / spread, np.nan)
+
+    df = pd.DataFrame({'std': std, 'std_norm': std_norm, 'mean': mean, 'mean_norm': mean_norm},
+                      index=counts.index)
+
+    # Areas with no counts at all are reported as zeros
+    df.loc[counts.sum(axis=1).to_numpy() == 0] = 0
 
+    # For null cells (caused by data with income of 0), normalised values need to be imputed as there was divide by zero error
+    na = df['std_norm'].isnull()
+    df.loc[na, 'std_norm'] = 0
+    df.loc[na, 'mean_norm'] = df.loc[na, 'mean']
+    return (df)
+
+
+# Columns read from each source. G02 feeds both income stages and the median stage, so all
+# of them read the same columns and only the first read parses the file.
+median_cols = ['Median_tot_prsnl_inc_weekly', 'Median_mortgage_repay_monthly', 'Median_rent_weekly',
+               'Median_tot_fam_inc_weekly', 'Average_num_psns_per_bedroom', 'Average_household_size',
+               'Median_age_persons', 'Median_tot_hhd_inc_weekly']
+median_dtypes = dict.fromkeys(median_cols, 'int64')
+median_dtypes.update({'Average_num_psns_per_bedroom': 'float64', 'Average_household_size': 'float64'})
+
+occu_cols = ['P_Tot_Managers', 'P_Tot_Professionals',
+             'P_Tot_TechnicTrades_W', 'P_Tot_CommunPersnlSvc_W', 'P_Tot_ClericalAdminis_W',
+             'P_Tot_Sales_W', 'P_Tot_Mach_oper_drivers', 'P_Tot_Labourers', 'P_Tot_Occu_ID_NS']
+
+status_cols = ['lfs_Emplyed_wrked_full_time_P',
+               'lfs_Emplyed_wrked_part_time_P',
+               'lfs_Employed_away_from_work_P',
+               'lfs_Unmplyed_lookng_for_wrk_P',
+               'lfs_Tot_LF_P',
+               'lfs_N_the_labour_force_P',
+               'Percent_Unem_loyment_P',
+               'Percnt_LabForc_prticipation_P',
+               'Percnt_Employment_to_populn_P']
+status_dtypes = dict.fromkeys(status_cols[:6], 'int64')
+status_dtypes.update(dict.fromkeys(status_cols[6:], 'float64'))
+
+# Raw inputs of the stages: DataPack table(s), columns and dtypes
+SOURCES = {'personal_income': (['G17A', 'G17B', 'G17C'], bin_columns(PERSONAL_INCOME_BINS), 'int64'),
+           'medians': ('G02', median_cols, median_dtypes),
+           'household_income': ('G29', bin_columns(HOUSEHOLD_INCOME_BINS), 'int64'),
+           'occupation': (['G57A', 'G57B'], occu_cols, 'int64'),
+           'population': ('G01', ['Tot_P_P'], 'int64'),
+           'employment': ('G40', status_cols, status_dtypes)}
+
+
+def source_tables(name):
+    tables = SOURCES[name][0]
+    return ([tables] if isinstance(tables, str) else tables)
+
+
+def source_columns(pack):
+    # Columns the sources read from every table of a DataPack, and their dtypes
+    columns = {}
+    for name in SOURCES:
+        _, cols, dtypes = pack.source_spec(name)
+        for table in source_tables(name):
+            table_cols, table_dtypes = columns.setdefault(table, ([], {}))
+            table_cols += [col for col in cols if col not in table_cols]
+            table_dtypes.update(dtypes if isinstance(dtypes, dict) else dict.fromkeys(cols, dtypes))
+    return (columns)
+
+
+def binned_inequality(counts, spec):
+    # Grouped percentiles, IQR and Gini coefficient of binned counts for every area at once.
+    # Percentiles interpolate linearly inside the bin where the cumulative count crosses them,
+    # between the bin's lower edge and the next bin's; the open top bin is taken as its lower edge.
+    # The Gini coefficient treats every count as sitting at the bin's midpoint.
+    import numpy as np
+    import pandas as pd
+
+    c = np.clip(counts.to_numpy(dtype=float), 0, None)
+    lower = np.array([row[2] for row in spec], dtype=float)
+    upper = np.append(lower[1:], lower[-1])
+    n = c.sum(axis=1)
+    cum = c.cumsum(axis=1)
+
+    df = pd.DataFrame(index=counts.index)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, q in [('p10', 0.1), ('p25', 0.25), ('grouped_median', 0.5), ('p75', 0.75), ('p90', 0.9)]:
+            target = q * n
+            j = (cum >= target[:, None]).argmax(axis=1)
+            rows = np.arange(c.shape[0])
+            below = cum[rows, j] - c[rows, j]
+            frac = (target - below) / c[rows, j]
+            df[name] = lower[j] + frac * (upper[j] - lower[j])
+        df['iqr'] = df['p75'] - df['p25']
+
+        order = np.argsort(bin_midpoints(spec), kind='stable')
+        v = np.asarray(bin_midpoints(spec), dtype=float)[order]
+        share = c[:, order] / n[:, None]
+        lorenz = (c[:, order] * v).cumsum(axis=1) / (c[:, order] @ v)[:, None]
+        lorenz_prev = np.hstack([np.zeros((c.shape[0], 1)), lorenz[:, :-1]])
+        df['gini'] = 1 - (share * (lorenz_prev + lorenz)).sum(axis=1)
+
+    # Areas with no counts (or no income at all for the Gini coefficient) are reported as zeros
+    return (df.fillna(0))
+
+
+# Each stage reads its sources and derives its features from them in a separate function,
+# so the roll-up can derive the same features from aggregated counts.
 
 # Weekly Income Personal
-def Load_wkly_prsnl_inc():
-    start_time = time.time()
-    file1 = dir + '2016Census_G17A_AUS_' + granularity + '.csv'
-    file2 = dir + '2016Census_G17B_AUS_' + granularity + '.csv'
-    file3 = dir + '2016Census_G17C_AUS_' + granularity + '.csv'
-
-    df_WeeklyIncomeA = pd.read_csv(file1)
-    df_WeeklyIncomeB = pd.read_csv(file2)
-    df_WeeklyIncomeC = pd.read_csv(file3)
-
-    df_WeeklyIncome = pd.concat([df_WeeklyIncomeA, df_WeeklyIncomeB, df_WeeklyIncomeC], axis=1)
-    df_WeeklyIncome = df_WeeklyIncome.loc[:, ~df_WeeklyIncome.columns.duplicated()]
-
-    df_WeeklyIncome['GeoLevel'] = df_WeeklyIncome[index_code]
-    df_WeeklyIncome = df_WeeklyIncome.set_index('GeoLevel')
-    df_WeeklyIncome['GeoLevel'] = df_WeeklyIncome[index_code]
-
-    Persons_Total_Cols = ['GeoLevel', 'P_Neg_Nil_income_Tot', 'P_1_149_Tot', 'P_150_299_Tot', 'P_300_399_Tot',
-                          'P_400_499_Tot', 'P_500_649_Tot', 'P_650_799_Tot', 'P_800_999_Tot',
-                          'P_1000_1249_Tot', 'P_1250_1499_Tot', 'P_1500_1749_Tot', 'P_1750_1999_Tot',
-                          'P_2000_2999_Tot', 'P_3000_more_Tot']  # 'P_PI_NS_ns_Tot' - Personal Income not stated col
-    Persons_Total_Cols_New = ['GeoLevel', 'Neg_Nil_income', '1_149', '150_299', '300_399', '400_499', '500_649', '650_799',
-                              '800_999', '1000_1249', '1250_1499', '1500_1749', '1750_1999', '2000_2999', '3000_more']
-
-    categories = {}
-    for i in Persons_Total_Cols[1:]:
-        categories.update({i: snip(i)})
-    df_WeeklyIncome = df_WeeklyIncome.rename(columns=categories, inplace=False)
-
-    df_WeeklyIncome = df_WeeklyIncome[Persons_Total_Cols_New]
-
-    df_WeeklyIncome_Transpose = df_WeeklyIncome[Persons_Total_Cols_New].transpose()
-
-    data = {}
-    geolevels_lst = df_WeeklyIncome_Transpose.columns.tolist()
-    for gl in geolevels_lst:
-        info_list = []
-        if sum(df_WeeklyIncome_Transpose[gl].tolist()[1:]) == 0:
-            data.update({gl: [gl, 0, 0, 0, 0]})
-        else:
-            info_list.append(gl)
-            info_list.append(summary(df_WeeklyIncome_Transpose,gl)[0].loc['std'])
-            info_list.append(summary(df_WeeklyIncome_Transpose,gl)[1].loc['std'])
-            info_list.append(summary(df_WeeklyIncome_Transpose,gl)[0].loc['mean'])
-            info_list.append(summary(df_WeeklyIncome_Transpose,gl)[1].loc['mean'])
-            data.update({gl: info_list})
-
-    df_overview = pd.DataFrame(data, columns=geolevels_lst, index=['GeoLevel', 'std', 'std_norm', 'mean', 'mean_norm'])
+def personal_income_features(df_WeeklyIncome, df_medians, spec=PERSONAL_INCOME_BINS):
+    df_overview = binned_summary(df_WeeklyIncome, bin_values(spec))
+    df_overview = df_overview.rename(columns={'std': 'std_personal_weekly_income',
+                                              'std_norm': 'std_norm_personal_weekly_income',
+                                              'mean': 'mean_personal_weekly_income',
+                                              'mean_norm': 'mean_norm_personal_weekly_income'})
+    df_inequality = binned_inequality(df_WeeklyIncome, spec)
+    df_inequality.columns = [col + '_personal_weekly_income' for col in df_inequality.columns]
+    df_overview = df_overview.join(df_inequality)
 
-    df_overview = df_overview.transpose()
+    # Process EXACT MEDIANS values
+    median = df_medians['Median_tot_prsnl_inc_weekly'].reindex(df_overview.index)
+    df_overview.insert(0, 'median_personal_weekly_income', median)
+    df_overview.insert(1, 'median_personal_weekly_income_interval', bin_labels(median, spec))
+    return(df_overview)
 
-    # For null cells (caused by data with income of 0), normalised values need to be imputed as there was divide by zero error
-    na_lst = df_overview[df_overview["std_norm"].isnull()]['GeoLevel'].tolist()
-    df_overview = df_overview.transpose()
-    for gl in na_lst:
-        df_overview[gl].loc['std_norm'] = 0
-        df_overview[gl].loc['mean_norm'] = df_overview[gl].loc['mean']
 
+def Load_wkly_prsnl_inc(pack):
+    start_time = time.time()
+    df_overview = personal_income_features(pack.read_source('personal_income'), pack.read_source('medians'),
+                                           pack.bins('personal_income'))
     print("Weekly Personal Income data processed in", (time.time() - start_time), "s\n")
     return(df_overview)
 
-def Load_median_data(df_overview):
-    start_time=time.time()
-    # Process EXACT MEDIANS values
 
-    file4 = dir + '2016Census_G02_AUS_' + granularity + '.csv'
-    df_medians = pd.read_csv(file4)
-    df_medians['GeoLevel'] = df_medians[index_code]
-    df_medians = df_medians.set_index('GeoLevel')
-
-    df_overview = df_overview.transpose()
-    df_overview['Exact Median prsnl inc weekly'] = df_medians['Median_tot_prsnl_inc_weekly']
-    df_overview['Median Total Personal Income (Weekly)'] = df_overview['Exact Median prsnl inc weekly'].apply(
-        lambda x: median_range(x))
-    df_overview = df_overview[
-        ['GeoLevel', 'Exact Median prsnl inc weekly', 'Median Total Personal Income (Weekly)', 'std', 'std_norm',
-         'mean',
-         'mean_norm']]
-
-    df_overview = df_overview.rename(columns={'Exact Median prsnl inc weekly': 'median_personal_weekly_income',
-                                              'Median Total Personal Income (Weekly)': 'median_personal_weekly_income_interval',
-                                              'std': 'std_personal_weekly_income',
-                                              'std_norm': 'std_norm_personal_weekly_income',
-                                              'mean': 'mean_personal_weekly_income',
-                                              'mean_norm': 'mean_norm_personal_weekly_income'})
-
-    df_overview['Median_mortgage_repay_monthly'] = df_medians['Median_mortgage_repay_monthly']
-    df_overview['Median_rent_weekly'] = df_medians['Median_rent_weekly']
-    df_overview['Median_tot_fam_inc_weekly'] = df_medians['Median_tot_fam_inc_weekly']
-    df_overview['Average_num_psns_per_bedroom'] = df_medians['Average_num_psns_per_bedroom']
-    df_overview['Average_household_size'] = df_medians['Average_household_size']
-    df_overview['median_age_persons'] = df_medians['Median_age_persons']
-    print("Median data processed in", (time.time() - start_time), "s\n")
+def median_features(df_medians):
+    df_overview = df_medians[['Median_mortgage_repay_monthly', 'Median_rent_weekly', 'Median_tot_fam_inc_weekly',
+                              'Average_num_psns_per_bedroom', 'Average_household_size', 'Median_age_persons']]
+    df_overview = df_overview.rename(columns={'Median_age_persons': 'median_age_persons'})
     return(df_overview)
-# Household Income
-def Load_hhld_wkly_inc(df_overview):
-    start_time=time.time()
-    file5 = dir + '2016Census_G29_AUS_' + granularity + '.csv'
-    df_hhld_income = pd.read_csv(file5)
-
-    df_hhld_income['GeoLevel'] = df_hhld_income[index_code]
 
-    df_hhld_income = df_hhld_income.set_index('GeoLevel')
 
-    df_hhld_income['GeoLevel'] = df_hhld_income[index_code]
+def Load_median_data(pack):
+    start_time=time.time()
+    df_overview = median_features(pack.read_source('medians'))
+    print("Median data processed in", (time.time() - start_time), "s\n")
+    return(df_overview)
 
-    hhld_Total_Cols = ['GeoLevel', 'Negative_Nil_income_Tot', 'HI_1_149_Tot', 'HI_150_299_Tot', 'HI_300_399_Tot',
-                       'HI_400_499_Tot', 'HI_500_649_Tot', 'HI_650_799_Tot', 'HI_800_999_Tot',
-                       'HI_1000_1249_Tot', 'HI_1250_1499_Tot', 'HI_1500_1749_Tot', 'HI_1750_1999_Tot',
-                       'HI_2000_2499_Tot', 'HI_2500_2999_Tot', 'HI_3000_3499_Tot', 'HI_3500_3999_Tot',
-                       'HI_4000_more_Tot']  # 'P_PI_NS_ns_Tot' - Personal Income not stated col
 
-    df_hhld_income = df_hhld_income[hhld_Total_Cols]
+# Household Income
+def household_income_features(df_hhld_income, df_medians, spec=HOUSEHOLD_INCOME_BINS):
+    df_hhld_inc_weekly = binned_summary(df_hhld_income, bin_values(spec))
+    df_hhld_inc_weekly = df_hhld_inc_weekly.join(binned_inequality(df_hhld_income, spec))
+    df_hhld_inc_weekly.columns = ['hhld_weekly_income_' + col for col in df_hhld_inc_weekly.columns]
 
-    df_hhld_income_Transpose = df_hhld_income.transpose()
+    median = df_medians['Median_tot_hhd_inc_weekly'].reindex(df_hhld_inc_weekly.index)
+    df_hhld_inc_weekly.insert(0, 'hhld_weekly_income_median', median)
+    df_hhld_inc_weekly.insert(1, 'hhld_weekly_income_median_interval', bin_labels(median, spec))
+    return(df_hhld_inc_weekly)
 
-    data = {}
-    geolevels_lst = df_hhld_income_Transpose.columns.tolist()
-    for gl in geolevels_lst:
-        info_list = []
-        if sum(df_hhld_income_Transpose[gl].tolist()[1:]) == 0:
-            data.update({gl: [gl, 0, 0, 0, 0]})
-        else:
-            info_list.append(gl)
-            info_list.append(summary_HI(df_hhld_income_Transpose,gl)[0].loc['std'])
-            info_list.append(summary_HI(df_hhld_income_Transpose,gl)[1].loc['std'])
-            info_list.append(summary_HI(df_hhld_income_Transpose,gl)[0].loc['mean'])
-            info_list.append(summary_HI(df_hhld_income_Transpose,gl)[1].loc['mean'])
-            data.update({gl: info_list})
-    df_overview2 = pd.DataFrame(data, columns=geolevels_lst,
-                                index=['GeoLevel', 'hhld_weekly_income_std', 'hhld_weekly_income_std_norm',
-                                       'hhld_weekly_income_mean', 'hhld_weekly_income_mean_norm'])
-
-    df_hhld_inc_weekly = df_overview2.transpose()
-
-    file4 = dir + '2016Census_G02_AUS_' + granularity + '.csv'
-    df_medians = pd.read_csv(file4)
-    df_medians['GeoLevel'] = df_medians[index_code]
-    df_medians = df_medians.set_index('GeoLevel')
-    df_hhld_inc_weekly['Median_tot_hhd_inc_weekly'] = df_medians['Median_tot_hhd_inc_weekly']
-
-    df_hhld_inc_weekly = df_hhld_inc_weekly[
-        ['GeoLevel', 'Median_tot_hhd_inc_weekly', 'hhld_weekly_income_std', 'hhld_weekly_income_std_norm',
-         'hhld_weekly_income_mean', 'hhld_weekly_income_mean_norm']]
-
-    na_lst = df_hhld_inc_weekly[df_hhld_inc_weekly["hhld_weekly_income_std_norm"].isnull()]['GeoLevel'].tolist()
-    df_hhld_inc_weekly = df_hhld_inc_weekly.transpose()
-    for gl in na_lst:
-        df_hhld_inc_weekly[gl].loc['hhld_weekly_income_std_norm'] = 0
-        df_hhld_inc_weekly[gl].loc['hhld_weekly_income_mean_norm'] = df_hhld_inc_weekly[gl].loc['hhld_weekly_income_mean']
-    df_hhld_inc_weekly = df_hhld_inc_weekly.transpose()
-
-    df_hhld_inc_weekly['hhld_weekly_income_median_interval'] = df_hhld_inc_weekly['Median_tot_hhd_inc_weekly'].apply(
-        lambda x: median_range_HI(x))
-    collst = df_hhld_inc_weekly.columns.tolist()
-    newlst = collst[:2] + ['hhld_weekly_income_median_interval'] + collst[2:-1]
-    df_hhld_inc_weekly = df_hhld_inc_weekly[newlst]
-
-    df_overview['hhld_weekly_income_median'] = df_hhld_inc_weekly['Median_tot_hhd_inc_weekly']
-    df_overview['hhld_weekly_income_median_interval'] = df_hhld_inc_weekly['hhld_weekly_income_median_interval']
-    df_overview['hhld_weekly_income_std'] = df_hhld_inc_weekly['hhld_weekly_income_std']
-    df_overview['hhld_weekly_income_std_norm'] = df_hhld_inc_weekly['hhld_weekly_income_std_norm']
-    df_overview['hhld_weekly_income_mean'] = df_hhld_inc_weekly['hhld_weekly_income_mean']
-    df_overview['hhld_weekly_income_mean_norm'] = df_hhld_inc_weekly['hhld_weekly_income_mean_norm']
 
+def Load_hhld_wkly_inc(pack):
+    start_time=time.time()
+    df_hhld_inc_weekly = household_income_features(pack.read_source('household_income'), pack.read_source('medians'),
+                                                   pack.bins('household_income'))
     print("Household Income data processed in", (time.time() - start_time), "s\n")
-    return(df_overview)
+    return(df_hhld_inc_weekly)
 
 
 # Occupation
-def Load_occupation_data(df_overview):
-    start_time = time.time()
-    file6 = dir + '2016Census_G57A_AUS_' + granularity + '.csv'
-    file7 = dir + '2016Census_G57B_AUS_' + granularity + '.csv'
-
-    df_occupationA = pd.read_csv(file6)
-    df_occupationB = pd.read_csv(file7)
-    df_occupation = pd.concat([df_occupationA, df_occupationB], axis=1)
-    df_occupation = df_occupation.loc[:, ~df_occupation.columns.duplicated()]
-
-    df_occupation['GeoLevel'] = df_occupation[index_code]
-    df_occupation = df_occupation.set_index('GeoLevel')
-    df_occupation['GeoLevel'] = df_occupation[index_code]
-
-    occu_cols = ['GeoLevel', 'P_Tot_Managers', 'P_Tot_Professionals',
-                 'P_Tot_TechnicTrades_W', 'P_Tot_CommunPersnlSvc_W', 'P_Tot_ClericalAdminis_W',
-                 'P_Tot_Sales_W', 'P_Tot_Mach_oper_drivers', 'P_Tot_Labourers', 'P_Tot_Occu_ID_NS']
-
-    df_occupation = df_occupation[occu_cols]
-
-    df_overview['occupation_total_Managers'] = df_occupation['P_Tot_Managers']
-    df_overview['occupation_total_Professionals'] = df_occupation['P_Tot_Professionals']
-    df_overview['occupation_total_TechTradeWorkers'] = df_occupation['P_Tot_TechnicTrades_W']
-    df_overview['occupation_total_CommunityPersonalService'] = df_occupation['P_Tot_CommunPersnlSvc_W']
-    df_overview['occupation_total_ClericalAdminWorkers'] = df_occupation['P_Tot_ClericalAdminis_W']
-    df_overview['occupation_total_SalesWorkers'] = df_occupation['P_Tot_Sales_W']
-    df_overview['occupation_total_MachineOperators'] = df_occupation['P_Tot_Mach_oper_drivers']
-    df_overview['occupation_total_Labourers'] = df_occupation['P_Tot_Labourers']
-    df_overview['occupation_total_NotStated'] = df_occupation['P_Tot_Occu_ID_NS']
+def occupation_features(df_occupation, df_population):
+    import pandas as pd
+
+    occu_names = ['occupation_total_Managers', 'occupation_total_Professionals',
+                  'occupation_total_TechTradeWorkers', 'occupation_total_CommunityPersonalService',
+                  'occupation_total_ClericalAdminWorkers', 'occupation_total_SalesWorkers',
+                  'occupation_total_MachineOperators', 'occupation_total_Labourers', 'occupation_total_NotStated']
+    df_occupation = df_occupation[occu_cols].set_axis(occu_names, axis=1)
 
     # Population & occupation standardising
+    df_overview = df_population.rename(columns={'Tot_P_P': 'population'})
+    df_overview = df_overview.join(df_occupation, how='left')
 
-    file8 = dir + '2016Census_G01_AUS_' + granularity + '.csv'
-    df_population = pd.read_csv(file8)
-    df_population['GeoLevel'] = df_population[index_code]
-    cols = ['GeoLevel', 'Tot_P_P']
-    df_population = df_population[cols]
-    n = df_population.shape[0]
-    df_population = df_population.sort_values(by=['GeoLevel'])
-    df_population[''] = list(range(0, n))
-    df_population = df_population.set_index('')
-
-    df_overview = df_overview.sort_index()
-    # df_overview['GeoLevel']=df_overview['GeoLevel'].apply(lambda x:int(x))
-    df_overview[''] = list(range(0, n))
-    df_overview = df_overview.set_index('')
-    df_overview = df_overview.sort_values(by=['GeoLevel'])
-
-    df_overview = pd.merge(left=df_population, right=df_overview, how='inner', left_on='GeoLevel', right_on='GeoLevel')
-    df_overview = df_overview.rename(columns={'Tot_P_P': 'population'})
-
-    df_overview['occupation_total_Managers_standardised'] = df_overview['occupation_total_Managers']/df_overview['population']
-    df_overview['occupation_total_Professionals_standardised'] = df_overview['occupation_total_Professionals']/df_overview['population']
-    df_overview['occupation_total_TechTradeWorkers_standardised'] = df_overview['occupation_total_TechTradeWorkers']/df_overview['population']
-    df_overview['occupation_total_CommunityPersonalService_standardised'] = df_overview['occupation_total_CommunityPersonalService']/df_overview['population']
-    df_overview['occupation_total_ClericalAdminWorkers_standardised'] = df_overview['occupation_total_ClericalAdminWorkers']/df_overview['population']
-    df_overview['occupation_total_SalesWorkers_standardised'] = df_overview['occupation_total_SalesWorkers']/df_overview['population']
-    df_overview['occupation_total_MachineOperators_standardised'] = df_overview['occupation_total_MachineOperators']/df_overview['population']
-    df_overview['occupation_total_Labourers_standardised'] = df_overview['occupation_total_Labourers']/df_overview['population']
-    df_overview['occupation_total_NotStated_standardised'] = df_overview['occupation_total_NotStated']/df_overview['population']
+    standardised = df_overview[occu_names].div(df_overview['population'], axis=0)
+    standardised.columns = [col + '_standardised' for col in occu_names]
+    df_overview = pd.concat([df_overview, standardised], axis=1)
+    return(df_overview)
 
+
+def Load_occupation_data(pack):
+    start_time = time.time()
+    df_overview = occupation_features(pack.read_source('occupation'), pack.read_source('population'))
     print("Occupation data processed in", (time.time() - start_time), "s\n")
     return(df_overview)
+
+
 # Employment
-def Load_emplyment_data(df_overview):
-    start_time = time.time()
-    file9 = dir + '2016Census_G40_AUS_' + granularity + '.csv'
-    df_edu = pd.read_csv(file9)
-    df_edu['GeoLevel'] = df_edu[index_code]
-
-    status_cols = ['GeoLevel', 'lfs_Emplyed_wrked_full_time_P',
-                   'lfs_Emplyed_wrked_part_time_P',
-                   'lfs_Employed_away_from_work_P',
-                   'lfs_Unmplyed_lookng_for_wrk_P',
-                   'lfs_Tot_LF_P',
-                   'lfs_N_the_labour_force_P',
-                   'Percent_Unem_loyment_P',
-                   'Percnt_LabForc_prticipation_P',
-                   'Percnt_Employment_to_populn_P',
-                   'Non_sch_quals_PostGrad_Dgre_P',
-                   'Non_sch_quals_Gr_Dip_Gr_Crt_P',
-                   'Non_sch_quals_Bchelr_Degree_P',
-                   'Non_sch_quls_Advncd_Dip_Dip_P',
-                   'Non_sch_quls_Cert3a4_Level_P',
-                   'Non_sch_quls_Cert1a2_Level_P',
-                   'Non_sch_quls_Certnfd_Level_P',
-                   'Non_sch_quls_CertTot_Level_P']
-
-    df_edu = df_edu[status_cols]
-    df_edu = df_edu.sort_values(by=['GeoLevel'])
+def employment_features(df_edu):
+    df_edu = df_edu.copy()
     df_edu['pct_full_time_labourforce'] = df_edu['lfs_Emplyed_wrked_full_time_P'] / df_edu['lfs_Tot_LF_P']
     df_edu['pct_part_time_labourforce_part_time_labourforce'] = df_edu['lfs_Emplyed_wrked_part_time_P'] / df_edu[
         'lfs_Tot_LF_P']
     df_edu['pct_labourforce_looking_for_work'] = df_edu['lfs_Unmplyed_lookng_for_wrk_P'] / df_edu['lfs_Tot_LF_P']
     df_edu = df_edu.fillna(0)
 
-    df_edu['pct_unemployment'] = df_edu['Percent_Unem_loyment_P'].apply(lambda x: x / 100)
-    del df_edu['Percent_Unem_loyment_P']
-    df_edu['pct_labourforce_participation'] = df_edu['Percnt_LabForc_prticipation_P'].apply(lambda x: x / 100)
-    del df_edu['Percnt_LabForc_prticipation_P']
-    df_edu['pct_employment_to_population'] = df_edu['Percnt_Employment_to_populn_P'].apply(lambda x: x / 100)
-    del df_edu['Percnt_Employment_to_populn_P']
+    df_edu['pct_unemployment'] = df_edu['Percent_Unem_loyment_P'] / 100
+    df_edu['pct_labourforce_participation'] = df_edu['Percnt_LabForc_prticipation_P'] / 100
+    df_edu['pct_employment_to_population'] = df_edu['Percnt_Employment_to_populn_P'] / 100
 
-    cols = ['GeoLevel', 'pct_full_time_labourforce',
+    cols = ['pct_full_time_labourforce',
             'pct_part_time_labourforce_part_time_labourforce', 'pct_labourforce_looking_for_work',
             'pct_unemployment', 'pct_labourforce_participation', 'pct_employment_to_population']
-    df_edu = df_edu[cols]
-
-    df_overview = pd.merge(left=df_edu, right=df_overview, how='inner', left_on='GeoLevel', right_on='GeoLevel')
+    return(df_edu[cols])
 
-    collst = df_overview.columns.tolist()
-    newlst = [collst[0]] + collst[7:] + collst[1:7]
-    df_overview = df_overview[newlst]
 
-    df_overview_final = df_overview.rename(columns={'GeoLevel': index_code})
+def Load_emplyment_data(pack):
+    start_time = time.time()
+    df_edu = employment_features(pack.read_source('employment'))
     print("Employment Data processed in", (time.time() - start_time), "s\n")
-    return(df_overview_final)
+    return(df_edu)
+
+
+def assemble(index_code, personal, medians, household, occupation, employment):
+    # One index-aligned join on the geography code. Areas need personal income, population
+    # and labour force data; the remaining tables are joined onto those areas.
+    import pandas as pd
 
-# Missing Vals
-def clean_up(df_overview_final):
-    to_delete1 = df_overview_final[(df_overview_final['population'] == 0)][index_code].tolist()
-    for i in to_delete1:
-        df_overview_final = df_overview_final[df_overview_final[index_code] != i]
+    keys = personal.index.intersection(occupation.index).intersection(employment.index).sort_values()
+    frames = [occupation[['population']], personal, medians, household,
+              occupation.drop(columns='population'), employment]
+    df_overview = pd.concat([frame.reindex(keys) for frame in frames], axis=1)
+
+    df_overview_final = df_overview.rename_axis(index_code).reset_index()
     return(df_overview_final)
 
 
+def check_keys(codes, granularity=None):
+    # Key integrity of the tables joined into the features. codes maps a table (or stage) name to
+    # its geography codes. Duplicate codes make the join ambiguous and raise; codes missing from
+    # some of the tables are reported (assemble leaves those areas out or their values missing).
+    # Returns the number of codes missing from each table that lacks some.
+    for name, index in codes.items():
+        if not index.is_unique:
+            duplicated = index[index.duplicated()].unique()
+            raise ValueError(str(len(duplicated)) + ' geography code(s) appear more than once in ' + name +
+                             ': ' + ', '.join(map(str, duplicated[:5])))
+
+    union = None
+    for index in codes.values():
+        union = index if union is None else union.union(index)
+    missing = {}
+    for name, index in codes.items():
+        absent = union.difference(index)
+        if len(absent):
+            missing[name] = len(absent)
+            print("Key check:", len(absent), "of", len(union), "codes missing from", name,
+                  "e.g.", ', '.join(map(str, absent[:3])))
+    emit_event({'event': 'validation', 'name': 'keys', 'granularity': granularity,
+                'codes': 0 if union is None else len(union), 'missing': missing})
+    return (missing)
+
+
+# Areas dropped from the features, by filter name: (feature, condition), condition being 'zero'
+# or 'missing'. DEFAULT_FILTERS are applied unless others are asked for.
+ROW_FILTERS = {'zero_population': ('population', 'zero'),
+               'zero_labour_force': ('pct_labourforce_participation', 'zero'),
+               'missing_median_income': ('median_personal_weekly_income', 'missing')}
+DEFAULT_FILTERS = ('zero_population',)
+
+
+def clean_up(df_overview_final, index_code, filters=DEFAULT_FILTERS):
+    # Drops the areas matching any of filters with a single boolean mask
+    import numpy as np
+
+    unknown = set(filters) - set(ROW_FILTERS)
+    if unknown:
+        raise ValueError('Unknown filter(s): ' + ', '.join(sorted(unknown)) + '; choose from ' + ', '.join(ROW_FILTERS))
+    drop = np.zeros(len(df_overview_final), dtype=bool)
+    dropped = {}
+    for name in filters:
+        column, condition = ROW_FILTERS[name]
+        if column not in df_overview_final.columns:
+            raise KeyError('Filter ' + name + ' needs the feature ' + column)
+        values = df_overview_final[column]
+        match = (values.isna() if condition == 'missing' else values == 0).to_numpy()
+        dropped[name] = int(match.sum())
+        drop |= match
+    emit_event({'event': 'filter', 'name': index_code, 'rows_in': len(df_overview_final),
+                'rows_out': int(len(df_overview_final) - drop.sum()), 'dropped': dropped})
+    return (df_overview_final[~drop])
+
+
+def final_frame(pack, personal, medians, household, occupation, employment):
+    # Checks the codes of the tables read in this run, and of the stages whose tables were not
+    # (their output was checkpointed), before joining and filtering them
+    codes = {'/'.join(source_tables(name)): index for name, index in pack.source_codes.items()}
+    for name, df in zip(STAGES, [personal, medians, household, occupation, employment]):
+        if not all(source in pack.source_codes for source in PIPELINE[name]['sources']):
+            codes[name + ' stage'] = df.index
+    check_keys(codes, pack.granularity)
+    df_overview_final = assemble(pack.index_code, personal, medians, household, occupation, employment)
+    return (clean_up(df_overview_final, pack.index_code, pack.filters))
+
+
+#=======================================================================
+#ROLL-UP
+#=======================================================================
+# Length of the SA1_MAINCODE_2016 prefix that is the code of each level above it
+ROLLUP_PREFIXES = {'SA2': 9, 'SA3': 5, 'SA4': 3}
+
+
+def parent_codes(codes, level, concordance=None):
+    # Code of the enclosing area at level for each SA1 code. A concordance (the ASGS SA1
+    # allocation file, with SA1_7DIGITCODE_2016 and the level's index code as columns) maps any
+    # SA1 code; without one, codes must be 11-digit SA1 main codes, which nest by prefix.
+    # SA1 codes the concordance does not map would be left out of every parent, so they raise.
+    import pandas as pd
+
+    codes = pd.Index(codes)
+    if concordance is not None:
+        mapping = concordance.drop_duplicates(INDEX_CODES['SA1']).set_index(INDEX_CODES['SA1'])[INDEX_CODES[level]]
+        parents = mapping.reindex(codes)
+        unmapped = codes[parents.isna().to_numpy()]
+        if len(unmapped):
+            raise ValueError(str(len(unmapped)) + ' of ' + str(len(codes)) + ' SA1 codes have no ' + level +
+                             ' in the concordance and would be dropped from the roll-up, e.g. ' +
+                             ', '.join(map(str, unmapped[:5])))
+        return (pd.Index(parents.to_numpy(), name=INDEX_CODES[level]))
+    if level not in ROLLUP_PREFIXES:
+        raise ValueError('Cannot roll SA1 up to ' + level + '; choose from ' + ', '.join(ROLLUP_PREFIXES))
+    if not codes.str.len().isin([11]).all():
+        raise ValueError('SA1 codes do not nest by prefix (7-digit codes); pass the ASGS SA1 allocation file '
+                         'as concordance')
+    return (pd.Index(codes.str[:ROLLUP_PREFIXES[level]], name=INDEX_CODES[level]))
+
+
+def aggregate_sources(raw, parents):
+    # Sums the additive sources over parents. Medians cannot be summed: the income medians are
+    # re-derived as grouped medians of the aggregated bins and the other G02 values are
+    # population-weighted means, which only approximate the true medians and averages.
+    # Percentages are recomputed from the aggregated labour force counts. Areas without a parent
+    # would be left out of every sum, so they raise.
+    for name, df in raw.items():
+        orphans = df.index.difference(parents.index)
+        if len(orphans):
+            raise ValueError(str(len(orphans)) + ' SA1 codes of ' + '/'.join(source_tables(name)) + ' have no ' +
+                             str(parents.name) + ' (they are not in ' + '/'.join(source_tables('population')) +
+                             ') and would be dropped from the roll-up, e.g. ' + ', '.join(map(str, orphans[:5])))
+
+    agg = {}
+    for name in ['personal_income', 'household_income', 'occupation', 'population']:
+        agg[name] = raw[name].groupby(parents.reindex(raw[name].index)).sum()
+
+    lfs = raw['employment'][status_cols[:6]].groupby(parents.reindex(raw['employment'].index)).sum()
+    persons = lfs['lfs_Tot_LF_P'] + lfs['lfs_N_the_labour_force_P']
+    employed = lfs['lfs_Tot_LF_P'] - lfs['lfs_Unmplyed_lookng_for_wrk_P']
+    lfs['Percent_Unem_loyment_P'] = 100 * lfs['lfs_Unmplyed_lookng_for_wrk_P'] / lfs['lfs_Tot_LF_P']
+    lfs['Percnt_LabForc_prticipation_P'] = 100 * lfs['lfs_Tot_LF_P'] / persons
+    lfs['Percnt_Employment_to_populn_P'] = 100 * employed / persons
+    agg['employment'] = lfs
+
+    weights = raw['population']['Tot_P_P'].reindex(raw['medians'].index).fillna(0)
+    weighted = raw['medians'].mul(weights, axis=0).groupby(parents.reindex(raw['medians'].index)).sum()
+    medians = weighted.div(weights.groupby(parents.reindex(raw['medians'].index)).sum(), axis=0)
+    medians['Median_tot_prsnl_inc_weekly'] = binned_inequality(agg['personal_income'],
+                                                                PERSONAL_INCOME_BINS)['grouped_median']
+    medians['Median_tot_hhd_inc_weekly'] = binned_inequality(agg['household_income'],
+                                                             HOUSEHOLD_INCOME_BINS)['grouped_median']
+    agg['medians'] = medians
+    return (agg)
+
+
+def features_from_sources(raw, index_code, filters=DEFAULT_FILTERS):
+    check_keys({'/'.join(source_tables(name)): df.index for name, df in raw.items()})
+    df_overview_final = assemble(index_code,
+                                 personal_income_features(raw['personal_income'], raw['medians']),
+                                 median_features(raw['medians']),
+                                 household_income_features(raw['household_income'], raw['medians']),
+                                 occupation_features(raw['occupation'], raw['population']),
+                                 employment_features(raw['employment']))
+    return (clean_up(df_overview_final, index_code, filters))
+
+
+def build_rollup(datapack_dir, levels=('SA2', 'SA3', 'SA4'), concordance=None, **options):
+    # Reads the SA1 DataPack once and returns the features of SA1 and of every level in levels,
+    # derived from the SA1 counts summed up the ASGS hierarchy. concordance is a path to the ASGS
+    # SA1 allocation file (see parent_codes).
+    # The options are those of build_features.
+    import pandas as pd
+
+    sink = add_event_sink(JsonLinesSink(options['events'])) if options.get('events') else None
+    try:
+        pack = DataPack('SA1', datapack_dir, options.get('index_code'), options.get('zip_path', ''),
+                        options.get('cache_dir'), options.get('cache', True), options.get('cache_size_mb', 2048),
+                        options.get('reader', 'c'), options.get('filters'))
+        raw = {name: pack.read_source(name) for name in SOURCES}
+        if concordance is not None:
+            concordance = pd.read_csv(concordance, dtype=str)
+
+        features = {'SA1': features_from_sources(raw, pack.index_code, pack.filters)}
+        codes = raw['population'].index
+        for level in levels:
+            start_time = time.time()
+            with measured('rollup', level, 'SA1') as event:
+                event['rows_in'] += len(codes)
+                parents = pd.Series(parent_codes(codes, level, concordance), index=codes)
+                features[level] = features_from_sources(aggregate_sources(raw, parents), INDEX_CODES[level],
+                                                        pack.filters)
+                event['rows_out'] = len(features[level])
+            print(level, "rolled up from SA1 in", (time.time() - start_time), "s\n")
+    finally:
+        if sink:
+            remove_event_sink(sink)
+    if options.get('compact', True):
+        features = {level: compact_features(df, df.columns[0]) for level, df in features.items()}
+    return (features)
+
+
+#=======================================================================
+#STREAMING
+#=======================================================================
+def stream_sources(pack, chunk_rows):
+    # Yields every source for the next chunk_rows areas, all tables being read side by side.
+    # DataPack tables list the areas of a granularity in the same order; this is checked on
+    # every chunk.
+    import pandas as pd
+    from contextlib import ExitStack
+
+    with ExitStack() as stack:
+        readers = {}
+        for name in SOURCES:
+            _, cols, dtypes = pack.source_spec(name)
+            wanted, dtype = pack.column_spec(cols, dtypes)
+            readers[name] = []
+            for table in source_tables(name):
+                f = stack.enter_context(open_part(*pack.source(table), pack.area))
+                readers[name].append(pd.read_csv(f, usecols=lambda c, wanted=wanted: c in wanted, dtype=dtype,
+                                                 chunksize=chunk_rows))
+
+        while True:
+            chunks = {name: [next(reader, None) for reader in parts] for name, parts in readers.items()}
+            ended = [chunk is None for parts in chunks.values() for chunk in parts]
+            if all(ended):
+                return
+            if any(ended):
+                raise ValueError('DataPack tables of ' + pack.granularity + ' have different numbers of rows; '
+                                 'build without streaming')
+
+            raw = {}
+            for name, parts in chunks.items():
+                df = combine_parts(parts, pack.index_code, pack.source_spec(name)[1], source_tables(name))
+                df = df.set_index(pack.index_code)
+                df.index.name = 'GeoLevel'
+                raw[name] = df
+            first = raw['population'].index
+            for name, df in raw.items():
+                if not df.index.equals(first):
+                    raise ValueError('Rows of ' + '/'.join(source_tables(name)) + ' are not aligned with G01 for '
+                                     + pack.granularity + '; build without streaming')
+            yield raw
+
+
+def stream_features(granularity, datapack_dir, output_path, chunk_rows=10000, index_code=None, zip_path='',
+                    filters=None):
+    # Builds the features chunk by chunk and appends each chunk to output_path, so memory use
+    # follows chunk_rows rather than the number of areas. Returns the number of areas written.
+    begin_time = time.time()
+    pack = DataPack(granularity, datapack_dir, index_code, zip_path, cache=False, filters=filters)
+    rows, chunks = 0, 0
+    for raw in stream_sources(pack, chunk_rows):
+        df_overview_final = features_from_sources(raw, pack.index_code, pack.filters)
+        df_overview_final.to_csv(output_path, mode='a' if chunks else 'w', header=not chunks, index=False)
+        rows += df_overview_final.shape[0]
+        chunks += 1
+    print(granularity, "streamed in", chunks, "chunks after", (time.time() - begin_time), "s")
+    return (rows)
+
+
+#=======================================================================
+#STAGE DAG
+#=======================================================================
+# Each node names the sources it reads, the nodes whose output it takes and the code its
+# result depends on. Outputs are checkpointed, and a node is only recomputed when its tables, its
+# code or an upstream node changed.
+READER_CODE = [DataPack.read_table, DataPack.column_spec, DataPack.read_indexed, DataPack.read_source,
+               DataPack.bins, DataPack.source_spec, DataPack.file_name, DataPack.source, DataPack.census_columns,
+               DataPack.census_reads,
+               DataPack.plan_reads, DataPack.read_columns, DataPack.read_part, DataPack.load_part, parse_part,
+               open_part, zip_member, read_csv_c, read_csv_arrow, combine_parts, check_keys, bin_columns]
+
+PIPELINE = {
+    'personal_income': {'func': Load_wkly_prsnl_inc, 'sources': ['personal_income', 'medians'], 'deps': [],
+                        'code': READER_CODE + [personal_income_features, binned_summary, binned_inequality,
+                                               bin_values, bin_midpoints, bin_labels, PERSONAL_INCOME_BINS]},
+    'medians': {'func': Load_median_data, 'sources': ['medians'], 'deps': [],
+                'code': READER_CODE + [median_features]},
+    'household_income': {'func': Load_hhld_wkly_inc, 'sources': ['household_income', 'medians'], 'deps': [],
+                         'code': READER_CODE + [household_income_features, binned_summary, binned_inequality,
+                                                bin_values, bin_midpoints, bin_labels,
+                                                HOUSEHOLD_INCOME_BINS]},
+    'occupation': {'func': Load_occupation_data, 'sources': ['occupation', 'population'], 'deps': [],
+                   'code': READER_CODE + [occupation_features]},
+    'employment': {'func': Load_emplyment_data, 'sources': ['employment'], 'deps': [],
+                   'code': READER_CODE + [employment_features]},
+    'features': {'func': final_frame, 'sources': [],
+                 'deps': ['personal_income', 'medians', 'household_income', 'occupation', 'employment'],
+                 'code': [assemble, clean_up, check_keys, source_tables, ROW_FILTERS]},
+}
+STAGES = [name for name in PIPELINE if not PIPELINE[name]['deps']]
+
+
+def code_version(name):
+    h = hashlib.sha1()
+    node = PIPELINE[name]
+    for obj in [node['func']] + node['code'] + [SOURCES[source] for source in node['sources']]:
+        h.update((inspect.getsource(obj) if callable(obj) else repr(obj)).encode())
+    return (h.hexdigest())
+
+
+def node_fingerprint(pack, name, upstream):
+    # Hash of everything a node's output depends on; upstream holds the fingerprints of its deps
+    h = hashlib.sha1(code_version(name).encode())
+    h.update(repr((pack.granularity, pack.index_code)).encode())
+    if pack.reader == 'arrow_dtypes':
+        h.update(pack.reader.encode())
+    if clean_up in PIPELINE[name]['code']:
+        h.update(repr(pack.filters).encode())
+    if pack.census['tables'] or pack.census['columns'] or pack.census['bins']:
+        h.update(repr((pack.census['tables'], pack.census['columns'], pack.census['bins'])).encode())
+    tables = [table for source in PIPELINE[name]['sources'] for table in source_tables(source)]
+    for table in sorted(set(tables)):
+        source, member = pack.source(table)
+        st = os.stat(source)
+        h.update(repr((os.path.abspath(source), member, st.st_size, st.st_mtime_ns)).encode())
+    for dep in PIPELINE[name]['deps']:
+        h.update(upstream[dep].encode())
+    return (h.hexdigest())
+
+
+def load_checkpoint(checkpoint_dir, name, fingerprint):
+    path = os.path.join(checkpoint_dir, name + '.' + fingerprint + '.pkl')
+    if not os.path.exists(path):
+        return (None)
+    with open(path, 'rb') as f:
+        return (pickle.load(f))
+
+
+def save_checkpoint(checkpoint_dir, name, fingerprint, df):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, name + '.' + fingerprint + '.pkl')
+    tmp_file = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, path)
+    # Only the latest checkpoint of a node is kept
+    for old in os.listdir(checkpoint_dir):
+        if old.startswith(name + '.') and old.endswith('.pkl') and old != os.path.basename(path):
+            os.remove(os.path.join(checkpoint_dir, old))
+
+
+def run_node(pack, name, inputs, profile_dir=None):
+    with measured('stage', name, pack.granularity, profile_dir) as event:
+        event['rows_in'] += sum(len(df) for df in inputs)
+        df = PIPELINE[name]['func'](pack, *inputs)
+        event['rows_out'] = len(df)
+    return (df)
+
+
+def run_pipeline(pack, threads=len(STAGES), checkpoint_dir=None, force=(), profile_dir=None):
+    # Runs the DAG, independent nodes side by side in a thread pool, and returns the output of
+    # every node. Without checkpoint_dir everything is computed; force names nodes (or 'all')
+    # to recompute even when their checkpoint is current, together with everything downstream.
+    # With profile_dir, every computed node is profiled into <granularity>_<node>.prof there.
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+    import pandas  # before any thread imports it, checkpoints are unpickled while stages run
+
+    if profile_dir:
+        threads = 1  # only one profiler can be active at a time on recent Pythons
+
+    force = set(PIPELINE) if 'all' in force else set(force)
+    unknown = force - set(PIPELINE)
+    if unknown:
+        raise ValueError('Unknown stage(s): ' + ', '.join(sorted(unknown)) + '. Choose from: ' + ', '.join(PIPELINE))
+
+    results, fingerprints, recomputed, running = {}, {}, set(), {}
+    pending = list(PIPELINE)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        while pending or running:
+            ready = [name for name in pending if all(dep in results for dep in PIPELINE[name]['deps'])]
+            for name in ready:
+                pending.remove(name)
+                node = PIPELINE[name]
+                fingerprints[name] = node_fingerprint(pack, name, fingerprints)
+                stale = name in force or any(dep in recomputed for dep in node['deps'])
+                if checkpoint_dir and not stale:
+                    with measured('checkpoint', name, pack.granularity) as event:
+                        df = load_checkpoint(checkpoint_dir, name, fingerprints[name])
+                        event['rows_out'] = None if df is None else len(df)
+                    if df is not None:
+                        print("Stage", name, "is up to date, checkpoint reused\n")
+                        results[name] = df
+                        continue
+                recomputed.add(name)
+                inputs = [results[dep] for dep in node['deps']]
+                running[pool.submit(run_node, pack, name, inputs, profile_dir)] = name
+            if ready and not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                if checkpoint_dir:
+                    save_checkpoint(checkpoint_dir, name, fingerprints[name], results[name])
+    return (results)
+
+
+#=======================================================================
+#FEATURE SPECS
+#=======================================================================
+# Features can also be declared in an INI file (see features.ini) instead of the stages above.
+# compile_spec turns it into a plan: the columns to read from every table, once, and the
+# transforms to apply to them; run_spec executes the plan on a DataPack.
+BINNED_STATS = ['std', 'std_norm', 'mean', 'mean_norm', 'p10', 'p25', 'grouped_median', 'p75', 'p90', 'iqr', 'gini']
+
+
+def spec_rename(frame, op):
+    return (frame[op['columns']].set_axis(op['names'], axis=1))
+
+
+def spec_ratio(frame, op):
+    return (frame[op['columns']].div(frame[op['denominator']], axis=0).set_axis(op['names'], axis=1))
+
+
+def spec_scale(frame, op):
+    if op['divisor'] is not None:
+        return ((frame[op['columns']] / op['divisor']).set_axis(op['names'], axis=1))
+    return ((frame[op['columns']] * op['factor']).set_axis(op['names'], axis=1))
+
+
+def spec_interval(frame, op):
+    import pandas as pd
+
+    return (pd.concat([bin_labels(frame[col], op['bins']) for col in op['columns']], axis=1, keys=op['names']))
+
+
+def spec_binned_stats(frame, op):
+    counts = frame[op['columns']]
+    df = binned_summary(counts, bin_values(op['bins'])).join(binned_inequality(counts, op['bins']))
+    return (df[op['stats']].set_axis([op['names'].format(stat=stat) for stat in op['stats']], axis=1))
+
+
+SPEC_TRANSFORMS = {'rename': spec_rename, 'ratio': spec_ratio, 'scale': spec_scale, 'interval': spec_interval,
+                   'binned_stats': spec_binned_stats}
+
+
+def compile_spec(path, bins=None):
+    # Reads a feature spec and returns its plan: {'tables': {table: columns}, 'ops': [...],
+    # 'drop_zero': feature or None}. Every table is listed once with the columns of all the
+    # sections that use it, so that it is parsed only once. bins replaces some of BIN_SPECS,
+    # e.g. with a census's own (see read_census_spec).
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(path):
+        raise FileNotFoundError('Feature spec not found: ' + path)
+
+    bin_specs = dict(BIN_SPECS, **(bins or {}))
+    tables, ops = {}, []
+    for name in config.sections():
+        if name == 'output':
+            continue
+        section = config[name]
+        transform = section.get('transform')
+        if transform not in SPEC_TRANSFORMS:
+            raise ValueError('[' + name + '] transform must be one of ' + ', '.join(SPEC_TRANSFORMS))
+        op = {'name': name, 'transform': transform, 'tables': section.get('table', '').split(),
+              'columns': section.get('columns', '').split(), 'names': section.get('names', '').split()}
+        if not op['tables']:
+            raise ValueError('[' + name + '] has no table')
+
+        if transform in ('interval', 'binned_stats'):
+            if section.get('bins') not in BIN_SPECS:
+                raise ValueError('[' + name + '] bins must be one of ' + ', '.join(BIN_SPECS))
+            op['bins'] = bin_specs[section['bins']]
+        if transform == 'binned_stats':
+            op['columns'] = bin_columns(op['bins'])
+            op['names'] = section.get('names', '{stat}')
+            op['stats'] = section.get('stats', ' '.join(BINNED_STATS)).split()
+            unknown = set(op['stats']) - set(BINNED_STATS)
+            if unknown:
+                raise ValueError('[' + name + '] unknown stats: ' + ', '.join(sorted(unknown)))
+        elif len(op['names']) != len(op['columns']):
+            raise ValueError('[' + name + '] needs as many names as columns')
+        if transform == 'ratio' and 'denominator' not in section:
+            raise ValueError('[' + name + '] ratio needs a denominator')
+        if transform == 'scale' and 'factor' not in section and 'divisor' not in section:
+            raise ValueError('[' + name + '] scale needs a factor or a divisor')
+        if transform == 'ratio':
+            op['denominator'] = section['denominator']
+        if transform == 'scale':
+            op['factor'] = section.getfloat('factor')
+            op['divisor'] = section.getfloat('divisor')
+        op['fillna'] = section.getfloat('fillna') if 'fillna' in section else None
+
+        needed = op['columns'] + ([op['denominator']] if transform == 'ratio' else [])
+        for table in op['tables']:
+            tables.setdefault(table, [])
+            tables[table] += [col for col in needed if col not in tables[table]]
+        ops.append(op)
+
+    drop_zero = config.get('output', 'drop_zero', fallback=None)
+    return ({'tables': tables, 'ops': ops, 'drop_zero': drop_zero})
+
+
+def run_spec(pack, plan, filters=None):
+    # Reads every table of the plan once and returns the features, one row per area present in
+    # all of the tables. Multi-part tables of an op are placed side by side as in read_table.
+    # Areas are dropped by filters (see clean_up) when given, else by the spec's drop_zero.
+    import pandas as pd
+
+    start_time = time.time()
+    with measured('stage', 'spec', pack.granularity) as event:
+        # Tables the sources read are read with their columns and dtypes too, so that a DataPack
+        # parses (and caches) them once for both. Columns an op needs from its tables are planned
+        # for all of them; those the sources read from another table are left to that one.
+        known = source_columns(pack)
+        elsewhere = {table: {col for other, (cols, _) in known.items() if other != table for col in cols}
+                     for table in known}
+        reads = []
+        for table, cols in plan['tables'].items():
+            source_cols, source_dtypes = known.get(table, ([], {}))
+            cols = source_cols + [col for col in cols if col not in source_cols and
+                                  col not in elsewhere.get(table, ())]
+            reads.append((table,) + pack.column_spec(cols, {col: source_dtypes[col] for col in cols
+                                                            if col in source_dtypes}))
+        pack.plan_reads(reads)
+        read = {}
+        for table, wanted, dtype in reads:
+            read[table] = pack.read_columns(table, wanted, dtype).set_index(pack.index_code)
+
+        check_keys({table: df.index for table, df in read.items()}, pack.granularity)
+        keys = None
+        for df in read.values():
+            keys = df.index if keys is None else keys.intersection(df.index)
+        keys = keys.sort_values()
+
+        features = []
+        for op in plan['ops']:
+            frame = pd.concat([read[table] for table in op['tables']], axis=1)
+            frame = frame.loc[:, ~frame.columns.duplicated()]
+            needed = op['columns'] + ([op['denominator']] if op['transform'] == 'ratio' else [])
+            missing = [col for col in needed if col not in frame.columns]
+            if missing:
+                raise KeyError('Columns missing from ' + '/'.join(op['tables']) + ': ' + ', '.join(missing))
+            df = SPEC_TRANSFORMS[op['transform']](frame.reindex(keys), op)
+            if op['fillna'] is not None:
+                df = df.fillna(op['fillna'])
+            features.append(df)
+
+        df_overview_final = pd.concat(features, axis=1).rename_axis(pack.index_code).reset_index()
+        if filters is not None:
+            df_overview_final = clean_up(df_overview_final, pack.index_code, filters)
+        elif plan['drop_zero']:
+            df_overview_final = df_overview_final[df_overview_final[plan['drop_zero']] != 0]
+        event['rows_out'] = len(df_overview_final)
+    print("Feature spec processed in", (time.time() - start_time), "s\n")
+    return (df_overview_final)
+
+
+#=======================================================================
+#COMPACT DTYPES
+#=======================================================================
+def compact_features(df, index_code):
+    # Shrinks the features frame in place of the default object/int64/float64 columns. Geography
+    # codes, unique to every area, become integers when they are numbers (SA1, SA2, SA3, SA4) and
+    # Arrow strings otherwise (with pyarrow); text repeating a few values (interval labels) becomes
+    # categorical, counts the smallest integer type that holds them and ratios (see
+    # similarity_columns) float32. Other float columns (means, medians, stds) keep float64.
+    # Prints the memory used before and after.
+    import pandas as pd
+
+    before = df.memory_usage(deep=True).sum()
+    ratios = set(similarity_columns(df))
+    compact = {}
+    for col in df.columns:
+        values = df[col]
+        if col == index_code:
+            compact[col] = compact_codes(values)
+        elif values.dtype == object and values.nunique() * 2 <= len(values):
+            compact[col] = values.astype('category')
+        elif pd.api.types.is_integer_dtype(values):
+            compact[col] = pd.to_numeric(values, downcast='integer')
+        elif values.dtype == 'float64' and col in ratios:
+            compact[col] = values.astype('float32')
+        else:
+            compact[col] = values
+    df = pd.DataFrame(compact, index=df.index)
+
+    after = df.memory_usage(deep=True).sum()
+    print("Features compacted from %.2f MB to %.2f MB" % (before / 2 ** 20, after / 2 ** 20))
+    return (df)
+
+
+def compact_codes(codes):
+    # Numeric codes without leading zeros as the smallest integer type, others as Arrow strings
+    # (kept as objects without pyarrow)
+    import pandas as pd
+
+    text = codes.astype(str)
+    if len(text) and text.str.fullmatch(r'[1-9][0-9]{0,17}').all():
+        return (pd.to_numeric(text, downcast='integer').rename(codes.name))
+    try:
+        import pyarrow
+    except ImportError:
+        return (codes)
+    return (codes.astype(pd.StringDtype('pyarrow')))
+
+
+#=======================================================================
+#OUTPUT
+#=======================================================================
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather', 'npy']
+
+
+def write_features(df, path, index_code, formats=('csv',), row_group_rows=10000):
+    # Writes the features to path + '.<format>' for every format in formats:
+    #   csv      plain text, as before
+    #   parquet  typed columns (interval labels stay categorical) in row groups of row_group_rows
+    #   feather  Arrow IPC file, for zero-copy reads
+    #   npy      float64 feature matrix for np.load(mmap_mode='r'), stored column by column, with the
+    #            geography codes in path + '.index.npy' and the column names, dtypes and interval
+    #            categories in path + '.schema.json'; categorical and text columns are stored as
+    #            category codes
+    # Parquet and Feather need pyarrow.
+    import numpy as np
+    import pandas as pd
+
+    unknown = set(formats) - set(OUTPUT_FORMATS)
+    if unknown:
+        raise ValueError('Unknown output format(s): ' + ', '.join(sorted(unknown)))
+    if set(formats) & {'parquet', 'feather'}:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('pyarrow is required to write parquet or feather output')
+
+    # Every file is written under a temporary name and moved into place once all are complete,
+    # so that readers (e.g. feature_service.py) never see part of one
+    suffix = '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    written, moves = [], []
+    try:
+        for fmt in formats:
+            if fmt == 'csv':
+                moves.append(path + '.csv')
+                df.to_csv(path + '.csv' + suffix, index=False)
+            elif fmt == 'parquet':
+                moves.append(path + '.parquet')
+                df.to_parquet(path + '.parquet' + suffix, index=False, row_group_size=row_group_rows)
+            elif fmt == 'feather':
+                moves.append(path + '.feather')
+                df.reset_index(drop=True).to_feather(path + '.feather' + suffix)
+            elif fmt == 'npy':
+                # The matrix goes into place after its index and schema
+                moves += [path + '.index.npy', path + '.schema.json', path + '.npy']
+                features = df.drop(columns=index_code)
+                index_dtype = df[index_code].dtype
+                if isinstance(index_dtype, pd.StringDtype):
+                    index_dtype = 'string[' + index_dtype.storage + ']'
+                schema = {'index_code': index_code, 'index_dtype': str(index_dtype), 'columns': []}
+                # Column-major, so that loading some of the columns only reads their part of the file
+                matrix = np.lib.format.open_memmap(path + '.npy' + suffix, mode='w+', dtype='float64',
+                                                   shape=features.shape, fortran_order=True)
+                for i, col in enumerate(features.columns):
+                    column = {'name': col, 'dtype': str(features[col].dtype)}
+                    values = features[col]
+                    if column['dtype'] in ('category', 'object'):
+                        values = values.astype('category')
+                        column['categories'] = values.cat.categories.tolist()
+                        column['ordered'] = bool(values.cat.ordered)
+                        values = values.cat.codes.where(values.cat.codes >= 0)
+                    matrix[:, i] = values.to_numpy(dtype='float64', na_value=np.nan)
+                    schema['columns'].append(column)
+                matrix.flush()
+                del matrix
+                with open(path + '.index.npy' + suffix, 'wb') as f:
+                    np.save(f, df[index_code].to_numpy(dtype=str))
+                with open(path + '.schema.json' + suffix, 'w') as f:
+                    json.dump(schema, f, indent=1)
+            written.append(path + '.' + fmt)
+    except BaseException:
+        for final in moves:
+            if os.path.exists(final + suffix):
+                os.remove(final + suffix)
+        raise
+
+    # The files of one build share a modification time, so that feature_file can tell them
+    # apart from those of older builds in other formats
+    stamp = time.time_ns()
+    for final in moves:
+        os.utime(final + suffix, ns=(stamp, stamp))
+        os.replace(final + suffix, final)
+    return (written)
+
+
+def read_features(path, columns=None):
+    # Reads features written by write_features back into a DataFrame, only loading columns
+    # (and the geography code) when given. The format follows from the file extension.
+    import numpy as np
+    import pandas as pd
+
+    if path.endswith('.parquet'):
+        if columns is None:
+            return (pd.read_parquet(path))
+        import pyarrow.parquet as parquet
+        first = parquet.read_schema(path).names[0]
+        return (pd.read_parquet(path, columns=[first] + list(columns)))
+    if path.endswith('.feather'):
+        if columns is None:
+            return (pd.read_feather(path))
+        import pyarrow.ipc as ipc
+        with ipc.open_file(path) as reader:
+            first = reader.schema.names[0]
+        return (pd.read_feather(path, columns=[first] + list(columns)))
+    if path.endswith('.npy'):
+        base = path[:-len('.npy')]
+        with open(base + '.schema.json') as f:
+            schema = json.load(f)
+        names = [col['name'] for col in schema['columns']]
+        wanted = names if columns is None else list(columns)
+        matrix = np.load(path, mmap_mode='r')
+        df = pd.DataFrame({schema['index_code']: np.load(base + '.index.npy').astype(object)})
+        if matrix.shape != (len(df), len(names)):
+            raise ValueError(path + ' does not match its index and schema files')
+        if schema.get('index_dtype', 'object') != 'object':
+            df[schema['index_code']] = df[schema['index_code']].astype(schema['index_dtype'])
+        for col in wanted:
+            column = schema['columns'][names.index(col)]
+            values = matrix[:, names.index(col)]
+            if 'categories' in column:
+                codes = np.nan_to_num(values, nan=-1).astype(int)
+                df[col] = pd.Categorical.from_codes(codes, categories=column['categories'],
+                                                    ordered=column.get('ordered', True))
+                if column['dtype'] == 'object':
+                    df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+            elif column['dtype'].startswith('float') or (column['dtype'].startswith('int')
+                                                         and not np.isnan(values).any()):
+                df[col] = values.astype(column['dtype'])
+            else:
+                df[col] = np.asarray(values)
+        return (df)
+    # Geography codes stay strings, as in the DataPack
+    first = pd.read_csv(path, nrows=0).columns[0]
+    if columns is None:
+        return (pd.read_csv(path, dtype={first: str}))
+    return (pd.read_csv(path, usecols=[first] + list(columns), dtype={first: str})[[first] + list(columns)])
+
+
+def feature_file(datapack_dir, granularity):
+    # The features file of a granularity from its latest build, in the fastest format it wrote
+    paths = [os.path.join(datapack_dir, 'features_by_' + granularity + '.' + fmt)
+             for fmt in ['feather', 'parquet', 'npy', 'csv']]
+    modified = {path: os.stat(path).st_mtime_ns for path in paths if os.path.exists(path)}
+    if not modified:
+        return (None)
+    return (next(path for path in paths if modified.get(path) == max(modified.values())))
+
+
+#=======================================================================
+#SIMILARITY
+#=======================================================================
+def similarity_columns(df):
+    # The normalised features, comparable across areas of any size
+    return ([col for col in df.columns if 'std_norm' in col or 'mean_norm' in col
+             or col.endswith('_standardised') or col.startswith('pct_')])
+
+
+def feature_matrix(df, columns=None):
+    # (codes, float32 matrix of the columns standardised to mean 0 and std 1, columns).
+    # Missing values and constant columns become 0, i.e. the average area.
+    import numpy as np
+
+    columns = columns or similarity_columns(df)
+    x = df[columns].to_numpy(dtype='float64')
+    x[~np.isfinite(x)] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = (x - np.nanmean(x, axis=0)) / np.nanstd(x, axis=0)
+    x[~np.isfinite(x)] = 0
+    return (df.iloc[:, 0].to_numpy(dtype=str), x.astype('float32'), columns)
+
+
+def prepare_rows(x, metric):
+    # Rows as compared: unit length for cosine similarity
+    import numpy as np
+
+    if metric == 'cosine':
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        return (x / np.where(norms > 0, norms, 1))
+    if metric == 'euclidean':
+        return (x)
+    raise ValueError('metric must be cosine or euclidean')
+
+
+def top_k(queries, x, k=10, metric='cosine', block_rows=8192, exclude=None, candidates=None):
+    # Best k rows of x for every query row, as (positions, scores) of shape (queries, k), best
+    # first: highest cosine similarity or lowest euclidean distance. x is compared in blocks of
+    # block_rows with one matrix product each, keeping memory at queries x block_rows. exclude
+    # holds, per query, a row of x to leave out (its own area); candidates restricts the search
+    # to those rows of x. Both are expected prepared with prepare_rows.
+    import numpy as np
+
+    rows = np.arange(x.shape[0]) if candidates is None else np.asarray(candidates)
+    k = min(k, len(rows) - (exclude is not None))
+    best_pos = np.full((queries.shape[0], 0), -1)
+    best_score = np.full((queries.shape[0], 0), -np.inf, dtype='float32')
+    q_sq = (queries ** 2).sum(axis=1)[:, None]
+    for start in range(0, len(rows), block_rows):
+        block = rows[start:start + block_rows]
+        b = x[block]
+        score = queries @ b.T
+        if metric == 'euclidean':
+            score = -np.sqrt(np.maximum(q_sq + (b ** 2).sum(axis=1)[None, :] - 2 * score, 0))
+        if exclude is not None:
+            score[block[None, :] == np.asarray(exclude)[:, None]] = -np.inf
+        pos = np.hstack([best_pos, np.broadcast_to(block, score.shape)])
+        score = np.hstack([best_score, score])
+        keep = np.argpartition(-score, k - 1, axis=1)[:, :k] if score.shape[1] > k else \
+            np.broadcast_to(np.arange(score.shape[1]), score.shape)
+        best_pos = np.take_along_axis(pos, keep, axis=1)
+        best_score = np.take_along_axis(score, keep, axis=1)
+
+    order = np.argsort(-best_score, axis=1, kind='stable')
+    best_pos = np.take_along_axis(best_pos, order, axis=1)
+    best_score = np.take_along_axis(best_score, order, axis=1)
+    return (best_pos, -best_score if metric == 'euclidean' else best_score)
+
+
+def build_similarity_index(df, path=None, metric='cosine', lists=None, columns=None, iterations=10, seed=0):
+    # Approximate index for large granularities (SA1): the prepared rows clustered into lists
+    # by k-means, so that a query only searches the lists nearest to it. Saved to path (.npz)
+    # when given, and returned as a dict.
+    import numpy as np
+
+    codes, x, columns = feature_matrix(df, columns)
+    x = prepare_rows(x, metric)
+    lists = lists or max(int(np.sqrt(len(x))), 1)
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), min(lists, len(x)), replace=False)]
+    for _ in range(iterations):
+        assign = top_k(x, centroids, 1, 'euclidean')[0][:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=len(centroids))[:, None]
+        centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids).astype('float32')
+    assign = top_k(x, centroids, 1, 'euclidean')[0][:, 0]
+
+    index = {'codes': codes, 'x': x, 'columns': np.array(columns), 'metric': np.array(metric),
+             'centroids': centroids, 'order': np.argsort(assign, kind='stable'),
+             'offsets': np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(centroids)))])}
+    if path:
+        np.savez(path, **index)
+    return (index)
+
+
+def load_similarity_index(path):
+    import numpy as np
+
+    with np.load(path) as data:
+        return ({name: data[name] for name in data.files})
+
+
+def similar_areas(df, codes, k=10, metric='cosine', columns=None, index=None, probes=8, block_rows=8192):
+    # The k areas most like each of codes, as a DataFrame of code, rank, similar_code and score
+    # (cosine similarity or euclidean distance of the standardised normalised features). With an
+    # index from build_similarity_index, only its probes nearest lists are searched.
+    import numpy as np
+    import pandas as pd
+
+    if index is not None:
+        all_codes, x, metric = index['codes'], index['x'], str(index['metric'])
+    else:
+        all_codes, x, columns = feature_matrix(df, columns)
+        x = prepare_rows(x, metric)
+    position = pd.Index(all_codes).get_indexer([str(code) for code in codes])
+    unknown = [code for code, pos in zip(codes, position) if pos < 0]
+    if unknown:
+        raise KeyError('Unknown code(s): ' + ', '.join(map(str, unknown)))
+
+    if index is None:
+        found, score = top_k(x[position], x, k, metric, block_rows, exclude=position)
+    else:
+        lists = top_k(x[position], index['centroids'], probes, 'euclidean')[0]
+        found, score = [], []
+        for i, pos in enumerate(position):
+            candidates = np.concatenate([index['order'][index['offsets'][j]:index['offsets'][j + 1]]
+                                         for j in lists[i]])
+            f, s = top_k(x[[pos]], x, k, metric, block_rows, exclude=[pos], candidates=candidates)
+            found.append(np.pad(f[0], (0, k - f.shape[1]), constant_values=-1))
+            score.append(np.pad(s[0].astype('float64'), (0, k - s.shape[1]), constant_values=np.nan))
+        found, score = np.array(found), np.array(score)
+
+    ranks = np.arange(1, found.shape[1] + 1)
+    result = pd.DataFrame({'code': np.repeat([str(code) for code in codes], found.shape[1]),
+                           'rank': np.tile(ranks, len(codes)),
+                           'similar_code': np.where(found >= 0, all_codes[found], None).ravel(),
+                           'score': score.ravel()})
+    return (result[result['similar_code'].notna()].reset_index(drop=True))
+
+
+#=======================================================================
+#NEIGHBOURHOODS
+#=======================================================================
+EARTH_RADIUS_KM = 6371.0088
+
+
+def read_centroids(path, codes=None):
+    # Latitude and longitude of every area, indexed by geography code, from a centroid csv (a
+    # code column and latitude/longitude columns) or an ASGS boundary file (shapefile, zipped
+    # shapefile, GeoPackage or GeoJSON; needs geopandas). The code column is the one sharing the
+    # most values with codes, or else the first one.
+    import pandas as pd
+
+    if path.lower().endswith(('.shp', '.zip', '.gpkg', '.geojson', '.json')):
+        try:
+            import geopandas
+        except ImportError:
+            raise ImportError('geopandas is required to read boundary files; give a centroid csv instead')
+        shapes = geopandas.read_file(path)
+        shapes = shapes[shapes.geometry.notna() & ~shapes.geometry.is_empty]
+        points = shapes.geometry.to_crs(3577).centroid.to_crs(4326)  # centroids taken in Australian Albers
+        df = pd.DataFrame(shapes.drop(columns=shapes.geometry.name))
+        df['latitude'], df['longitude'] = points.y.to_numpy(), points.x.to_numpy()
+    else:
+        df = pd.read_csv(path, dtype=str)
+
+    names = {col.lower(): col for col in df.columns}
+    lat = next((names[name] for name in ('latitude', 'lat', 'y') if name in names), None)
+    lon = next((names[name] for name in ('longitude', 'lon', 'lng', 'long', 'x') if name in names), None)
+    if lat is None or lon is None:
+        raise ValueError('No latitude and longitude columns in ' + path)
+    candidates = [col for col in df.columns if col not in (lat, lon)]
+    code = candidates[0]
+    if codes is not None:
+        codes = pd.Index(codes).astype(str)
+        overlap = {col: codes.isin(df[col].astype(str)).sum() for col in candidates}
+        code = max(candidates, key=lambda col: overlap[col]) if max(overlap.values()) else code
+
+    centroids = pd.DataFrame({'latitude': pd.to_numeric(df[lat]).to_numpy(),
+                              'longitude': pd.to_numeric(df[lon]).to_numpy()},
+                             index=pd.Index(df[code].astype(str), name='code')).dropna()
+    check_keys({os.path.basename(path): centroids.index})
+    return (centroids)
+
+
+def unit_vectors(latitude, longitude):
+    # Points on the unit sphere; straight-line distances between them order areas as the
+    # distances along the Earth's surface do
+    import numpy as np
+
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    return (np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]))
+
+
+def neighbourhood_features(df, centroids, columns=None, k=(), radius_km=(), weight='population', batch_rows=8192):
+    # Appends the weighted average of columns (default: all numeric features but weight) over
+    # the neighbours of every area: its k nearest areas, itself included, as <column>_knn<k>,
+    # and all areas within radius_km of its centroid as <column>_r<radius>km, for each k and
+    # radius given. Neighbours are the areas of df with a centroid; missing values are left out
+    # of the averages and weight=None weighs areas equally. The centroids are put in a KD-tree
+    # once, queried batch_rows areas at a time, and every batch is averaged with one sparse
+    # matrix product.
+    import numpy as np
+    import pandas as pd
+    try:
+        from scipy.sparse import csr_matrix
+        from scipy.spatial import cKDTree
+    except ImportError:
+        raise ImportError('scipy is required for neighbourhood features')
+
+    columns = columns or [col for col in df.columns[1:] if col != weight and pd.api.types.is_numeric_dtype(df[col])]
+    missing = [col for col in columns + ([weight] if weight else []) if col not in df.columns]
+    if missing:
+        raise KeyError('Columns not in the features: ' + ', '.join(missing))
+
+    codes = df.iloc[:, 0].astype(str).to_numpy()
+    position = centroids.index.get_indexer(codes)
+    located = np.flatnonzero(position >= 0)
+    if len(located) < len(df):
+        print("Neighbourhoods:", len(df) - len(located), "of", len(df), "areas have no centroid e.g.",
+              ', '.join(codes[position < 0][:3]))
+    points = unit_vectors(centroids['latitude'].to_numpy()[position[located]],
+                          centroids['longitude'].to_numpy()[position[located]])
+    tree = cKDTree(points)
+
+    values = df[columns].to_numpy(dtype='float64')[located]
+    present = np.isfinite(values)
+    weights = df[weight].to_numpy(dtype='float64')[located] if weight else np.ones(len(located))
+    weighted = np.where(present, values, 0) * weights[:, None]
+    counted = present * weights[:, None]
+
+    added = {}
+    for size, suffix in [(n, '_knn' + str(n)) for n in k] + [(r, '_r' + format(r, 'g') + 'km') for r in radius_km]:
+        averages = np.full((len(df), len(columns)), np.nan)
+        for start in range(0, len(located), batch_rows):
+            batch = points[start:start + batch_rows]
+            if suffix.startswith('_knn'):
+                found = tree.query(batch, min(size, len(located)))[1].reshape(len(batch), -1)
+                lengths, found = np.full(len(batch), found.shape[1]), found.ravel()
+            else:
+                chord = 2 * np.sin(min(size / (2 * EARTH_RADIUS_KM), np.pi / 2))
+                lists = tree.query_ball_point(batch, chord)
+                lengths = np.array([len(neighbours) for neighbours in lists])
+                found = np.concatenate(lists).astype(int)
+            adjacency = csr_matrix((np.ones(len(found)), (np.repeat(np.arange(len(batch)), lengths), found)),
+                                   shape=(len(batch), len(located)))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                averages[located[start:start + len(batch)]] = (adjacency @ weighted) / (adjacency @ counted)
+        for j, col in enumerate(columns):
+            added[col + suffix] = averages[:, j]
+    return (pd.concat([df, pd.DataFrame(added, index=df.index)], axis=1))
+
 
 #=======================================================================
 #DATA PREPARATION
 #=======================================================================
-begin_time=time.time()
+def build_features(granularity, datapack_dir, index_code=None, zip_path='', cache_dir=None, cache=True,
+                   cache_size_mb=2048, threads=len(STAGES), checkpoint_dir=None, force=(), compact=True,
+                   events=None, profile_dir=None, trace_memory=False, spec=None, reader='c', filters=None,
+                   census=None, centroids=None, knn=(), radius_km=(), neighbour_columns=None,
+                   neighbour_weight='population'):
+    # Builds the features of one granularity and returns them as a DataFrame. With a
+    # checkpoint_dir, stages whose inputs and code did not change are loaded instead of rebuilt.
+    # With compact, the frame is passed through compact_features before it is returned.
+    # events is a JSON lines file the stage and read events are appended to; trace_memory adds
+    # tracemalloc peaks to them. spec is a feature spec file (see compile_spec) to build instead of
+    # the built-in stages; it is not checkpointed. reader is the CSV parser of READERS to use and
+    # filters the ROW_FILTERS dropping areas (default: DEFAULT_FILTERS, or the spec's drop_zero).
+    # census is a census spec (see read_census_spec) for a DataPack other than 2016's. With a
+    # centroids file, the neighbourhood_features of the knn nearest areas and of the areas within
+    # radius_km are appended.
+    sink = add_event_sink(JsonLinesSink(events)) if events else None
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        pack = DataPack(granularity, datapack_dir, index_code, zip_path, cache_dir, cache, cache_size_mb, reader,
+                        filters, census)
+        if checkpoint_dir:
+            checkpoint_dir = os.path.join(checkpoint_dir, *([census['year']] if census else []), granularity)
+        if spec:
+            df_overview_final = run_spec(pack, compile_spec(spec, pack.census['bins']), filters)
+        else:
+            pack.plan_reads([(table,) + pack.column_spec(*pack.source_spec(name)[1:])
+                             for name in SOURCES for table in source_tables(name)])
+            df_overview_final = run_pipeline(pack, threads, checkpoint_dir, force, profile_dir)['features']
+        if centroids and (knn or radius_km):
+            start_time = time.time()
+            with measured('stage', 'neighbourhoods', granularity, profile_dir) as event:
+                event['rows_in'] += len(df_overview_final)
+                df_overview_final = neighbourhood_features(
+                    df_overview_final, read_centroids(centroids, df_overview_final.iloc[:, 0]), neighbour_columns,
+                    knn, radius_km, neighbour_weight)
+                event['rows_out'] = len(df_overview_final)
+            print("Neighbourhood features processed in", (time.time() - start_time), "s\n")
+        if compact:
+            df_overview_final = compact_features(df_overview_final, pack.index_code)
+    finally:
+        if tracing:
+            tracemalloc.stop()
+        if sink:
+            remove_event_sink(sink)
+    return (df_overview_final)
+
+
+def build_granularity(granularity, datapack_dir, formats=('csv',), **options):
+    # Builds one granularity and writes its features files next to the DataPack.
+    # Also the worker of the batch mode.
+    begin_time = time.time()
+    df_overview_final = build_features(granularity, datapack_dir, **options)
+
+    write_features(df_overview_final, os.path.join(datapack_dir, 'features_by_' + granularity),
+                   df_overview_final.columns[0], formats)
+    elapsed = time.time() - begin_time
+    print("Final dataframe exported after", elapsed, "s")
+    return (granularity, df_overview_final.shape[0], elapsed)
+
+
+def build_batch(granularities, datapack_dir, jobs=1, **options):
+    # Builds several granularities in parallel worker processes
+    from concurrent.futures import ProcessPoolExecutor
+
+    begin_time = time.time()
+    if jobs <= 1:
+        results = [build_granularity(gran, datapack_dir, **options) for gran in granularities]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(build_granularity, gran, datapack_dir, **options) for gran in granularities]
+            results = [future.result() for future in futures]
+
+    print("\nBatch summary")
+    for gran, rows, elapsed in results:
+        print("  %-4s %8d areas %10.2f s" % (gran, rows, elapsed))
+    print("  total (%d jobs) %.2f s wall, %.2f s summed" %
+          (jobs, time.time() - begin_time, sum(r[2] for r in results)))
+    return (results)
+
+
+PANEL_LAYOUTS = ['long', 'wide']
+
+
+def panel_frame(frames, granularity, layout='long'):
+    # Joins the features of several Census years (frames maps year to features) keyed by
+    # geography code: 'long' has a row per area and year, 'wide' a row per area with the
+    # features of every year suffixed _<year>. Every year must give the same features.
+    import pandas as pd
+
+    key = granularity + '_CODE'
+    frames = {year: df.rename(columns={df.columns[0]: key}) for year, df in frames.items()}
+    first_year, first = next(iter(frames.items()))
+    for year, df in frames.items():
+        if list(df.columns) != list(first.columns):
+            differ = set(df.columns) ^ set(first.columns)
+            raise ValueError('Features of ' + year + ' differ from those of ' + first_year +
+                             (': ' + ', '.join(sorted(differ)) if differ else ' in order'))
+
+    if layout == 'long':
+        parts = []
+        for year, df in frames.items():
+            df = df.copy()
+            df.insert(1, 'year', int(year))
+            parts.append(df)
+        return (pd.concat(parts, ignore_index=True))
+    if layout != 'wide':
+        raise ValueError('Unknown panel layout ' + layout + '; choose from ' + ', '.join(PANEL_LAYOUTS))
+    wide = pd.concat([df.set_index(key).add_suffix('_' + year) for year, df in frames.items()], axis=1)
+    wide = wide[[col + '_' + year for col in first.columns[1:] for year in frames]]
+    return (wide.rename_axis(key).reset_index())
+
+
+def build_panel(census_specs, granularity, datapack_dir, jobs=1, layout='long', formats=('csv',), **options):
+    # Builds one granularity for every census spec (see read_census_spec), each year in its own
+    # worker process, and writes them as one panel (see panel_frame) next to the DataPack. The
+    # DataPack of a year is looked for in the dir and zip of its spec, or in datapack_dir.
+    from concurrent.futures import ProcessPoolExecutor
+
+    begin_time = time.time()
+    censuses = [read_census_spec(path) for path in census_specs]
+    years = [census['year'] for census in censuses]
+    if len(set(years)) != len(years):
+        raise ValueError('Several census specs are for the same year: ' + ', '.join(years))
+
+    runs = [dict(options, granularity=granularity, datapack_dir=census['dir'] or datapack_dir,
+                 zip_path=census['zip'], census=census) for census in censuses]
+    if jobs <= 1:
+        frames = [build_features(**run) for run in runs]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(build_features, **run) for run in runs]
+            frames = [future.result() for future in futures]
+
+    df_panel = panel_frame(dict(zip(years, frames)), granularity, layout)
+    write_features(df_panel, os.path.join(datapack_dir, 'features_by_' + granularity + '_panel'),
+                   df_panel.columns[0], formats)
+    for year, df in zip(years, frames):
+        print("  %s %8d areas" % (year, len(df)))
+    print("Panel of", granularity, "for", ', '.join(years), "exported after", (time.time() - begin_time), "s")
+    return (df_panel)
+
+
+def main(argv=None):
+    import argparse
+
+    capture_warnings()
+    parser = argparse.ArgumentParser(description='Build ABS census features by geographic level.')
+    parser.add_argument('--config', default='config.ini', help='parameters file (default: config.ini)')
+    parser.add_argument('--granularity', nargs='+', choices=sorted(INDEX_CODES),
+                        help='one or more granularities to build (default: from the config file)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes used when building several granularities')
+    parser.add_argument('--threads', type=int, default=len(STAGES),
+                        help='threads used to run the stages of one granularity concurrently')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse every table from source and leave the table cache untouched')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='empty the table cache before building')
+    parser.add_argument('--force', action='append', default=[], choices=list(PIPELINE) + ['all'],
+                        help='recompute a stage (repeatable, or all) even if its checkpoint is current')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='recompute every stage and do not write checkpoints')
+    parser.add_argument('--rollup', nargs='+', choices=['SA2', 'SA3', 'SA4'],
+                        help='read the SA1 DataPack once and build SA1 and these levels from its counts')
+    parser.add_argument('--concordance',
+                        help='ASGS SA1 allocation file mapping SA1 codes to the roll-up levels')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the tables in chunks of areas and append each chunk to the output, '
+                             'keeping memory use flat (no cache or checkpoints)')
+    parser.add_argument('--chunk-rows', type=int, default=10000,
+                        help='areas per chunk in streaming mode (default: 10000)')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the features with compact dtypes (float32 ratios) before '
+                             'writing them; changes the printed precision of csv output')
+    parser.add_argument('--format', nargs='+', default=['csv'], choices=OUTPUT_FORMATS,
+                        help='output formats (default: csv); parquet and feather need pyarrow')
+    parser.add_argument('--features', metavar='SPEC',
+                        help='build the features declared in this spec file (e.g. features.ini) instead of '
+                             'the built-in stages')
+    parser.add_argument('--reader', choices=['c', 'arrow', 'arrow_dtypes'], default='c',
+                        help='CSV parser: pandas C (default), multithreaded Arrow, or Arrow keeping Arrow '
+                             'dtypes; the arrow readers need pyarrow')
+    parser.add_argument('--filters', nargs='*', choices=list(ROW_FILTERS),
+                        help='drop the areas matching any of these filters (default: zero_population, or the '
+                             'drop_zero of a --features spec; give none to keep every area)')
+    parser.add_argument('--panel', nargs='+', metavar='CENSUS_SPEC',
+                        help='build every granularity for each of these census specs (e.g. census_2016.ini), '
+                             'the years in parallel worker processes, into one features_by_<granularity>_panel')
+    parser.add_argument('--panel-layout', choices=PANEL_LAYOUTS, default='long',
+                        help='panel output: a row per area and year (long, default) or a row per area with '
+                             'year-suffixed features (wide)')
+    parser.add_argument('--centroids',
+                        help='centroid csv (code, latitude, longitude) or ASGS boundary file of the granularity; '
+                             'with --knn or --radius-km, neighbourhood averages are appended to the features')
+    parser.add_argument('--knn', nargs='+', type=int, default=[],
+                        help='average the features over the k nearest areas, for each k given')
+    parser.add_argument('--radius-km', nargs='+', type=float, default=[],
+                        help='average the features over the areas within this distance, for each radius given')
+    parser.add_argument('--neighbour-columns', nargs='+',
+                        help='features to average over neighbourhoods (default: all numeric features)')
+    parser.add_argument('--neighbour-weight', default='population',
+                        help='feature weighting the neighbourhood averages (default: population; none for '
+                             'equal weights)')
+    parser.add_argument('--events',
+                        help='append a JSON line per stage, table read and warning to this file')
+    parser.add_argument('--profile-dir',
+                        help='write a cProfile dump of every stage to this directory (runs stages one at a time)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='add tracemalloc memory peaks to the events (slows the build down)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    similar = commands.add_parser('similar', help='list the areas most like the given ones, from the features '
+                                                  'file already built (run "similar -h" for its options)')
+    similar.add_argument('codes', nargs='+', help='geography codes to find similar areas for')
+    similar.add_argument('--level', choices=sorted(INDEX_CODES),
+                         help='granularity of the codes (default: from the config file)')
+    similar.add_argument('-k', type=int, default=10, help='similar areas per code (default: 10)')
+    similar.add_argument('--metric', choices=['cosine', 'euclidean'], default='cosine')
+    similar.add_argument('--index',
+                         help='approximate index file (.npz) to search, built from the features when missing '
+                              'or older than them; worth it for SA1')
+    similar.add_argument('--probes', type=int, default=8, help='index lists searched per code (default: 8)')
+    args = parser.parse_args(argv)
+    if set(args.format) & {'parquet', 'feather'} or args.reader != 'c':
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error('pyarrow is required for parquet or feather output and the arrow readers')
+    if (args.knn or args.radius_km) and not args.centroids:
+        parser.error('--knn and --radius-km need --centroids')
+    if args.centroids:
+        try:
+            import scipy
+        except ImportError:
+            parser.error('scipy is required for neighbourhood features')
+
+    params = read_config(args.config)
+    if args.command == 'similar':
+        gran = args.level or params['granularity']
+        path = feature_file(params['datapack_dir'], gran) if gran else None
+        if path is None:
+            parser.error('no features file for ' + str(gran) + ' in ' + params['datapack_dir'] + '; build it first')
+        df = read_features(path)
+        index = None
+        if args.index and os.path.exists(args.index) and os.path.getmtime(args.index) >= os.path.getmtime(path):
+            index = load_similarity_index(args.index)
+        elif args.index:
+            index = build_similarity_index(df, args.index, args.metric)
+        try:
+            result = similar_areas(df, args.codes, args.k, args.metric, index=index, probes=args.probes)
+        except KeyError as e:
+            parser.error(e.args[0])
+        print(result.to_string(index=False))
+        return
+    checkpoint_dir = None
+    if not args.no_checkpoint:
+        checkpoint_dir = params['checkpoint_dir'] or os.path.join(params['datapack_dir'], '.abs_checkpoints')
+    options = {'zip_path': params['zip_path'], 'cache_dir': params['cache_dir'], 'cache': not args.no_cache,
+               'cache_size_mb': params['cache_size_mb'], 'threads': args.threads,
+               'checkpoint_dir': checkpoint_dir, 'force': args.force, 'compact': args.compact,
+               'events': args.events, 'profile_dir': args.profile_dir, 'trace_memory': args.trace_memory,
+               'spec': args.features, 'reader': args.reader, 'filters': args.filters,
+               'centroids': args.centroids, 'knn': args.knn, 'radius_km': args.radius_km,
+               'neighbour_columns': args.neighbour_columns,
+               'neighbour_weight': None if args.neighbour_weight == 'none' else args.neighbour_weight}
+    if args.clear_cache:
+        clear_cache(params['cache_dir'] or os.path.join(params['datapack_dir'], '.abs_cache'))
+
+    if args.features and (args.rollup or args.stream):
+        parser.error('--features cannot be combined with --rollup or --stream')
+    if args.panel and (args.rollup or args.stream):
+        parser.error('--panel cannot be combined with --rollup or --stream')
+    if args.centroids and (args.rollup or args.stream):
+        parser.error('--centroids cannot be combined with --rollup or --stream')
+    if args.rollup:
+        begin_time = time.time()
+        index_code = params['index_code'] if params['granularity'] == 'SA1' else None
+        if not args.concordance and (index_code or INDEX_CODES['SA1']) == INDEX_CODES['SA1']:
+            parser.error('the 7-digit SA1 codes of ' + INDEX_CODES['SA1'] + ' do not nest by prefix; '
+                         '--rollup needs --concordance')
+        features = build_rollup(params['datapack_dir'], args.rollup, args.concordance, index_code=index_code,
+                                **options)
+        for level, df_overview_final in features.items():
+            write_features(df_overview_final, os.path.join(params['datapack_dir'], 'features_by_' + level),
+                           df_overview_final.columns[0], args.format)
+        print("Roll-up exported after", (time.time() - begin_time), "s")
+        return
+
+    granularities = args.granularity or [params['granularity']]
+    if granularities == [None]:
+        parser.error('no granularity given and none set in ' + args.config)
+    if args.panel:
+        for gran in granularities:
+            build_panel(args.panel, gran, params['datapack_dir'], min(args.jobs, len(args.panel)), args.panel_layout,
+                        args.format, **options)
+    elif args.stream:
+        if args.format != ['csv'] or args.reader != 'c':
+            parser.error('streaming mode only writes csv, with the C reader')
+        for gran in granularities:
+            index_code = params['index_code'] if gran == params['granularity'] else None
+            stream_features(gran, params['datapack_dir'],
+                            os.path.join(params['datapack_dir'], 'features_by_' + gran + '.csv'),
+                            args.chunk_rows, index_code, params['zip_path'], args.filters)
+    elif len(granularities) == 1:
+        gran = granularities[0]
+        index_code = params['index_code'] if gran == params['granularity'] else None
+        build_granularity(gran, params['datapack_dir'], args.format, index_code=index_code, **options)
+    else:
+        build_batch(granularities, params['datapack_dir'], min(args.jobs, len(granularities)),
+                    formats=args.format, **options)
 
-stage1=Load_wkly_prsnl_inc()
-stage2=Load_median_data(stage1)
-stage3=Load_hhld_wkly_inc(stage2)
-stage4=Load_occupation_data(stage3)
-stage5=Load_emplyment_data(stage4)
-df_overview_final=clean_up(stage5)
 
-df_overview_final.to_csv(directory+'/features_by_'+granularity+'.csv', index=False)
-print("Final dataframe exported after", (time.time() - begin_time), "s")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# Writes a synthetic 2016 Census GCP DataPack for testing and benchmarking source_abs.py
+
+import os
+import argparse
+
+from source_abs import DataPack, INDEX_CODES, SOURCES, PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS, \
+    source_tables, bin_columns, bin_values, occu_cols, status_cols
+
+"""Synthetic DataPack
+
+Writes 2016Census_<table>_AUS_<granularity>.csv files with the layout of the real DataPack:
+the columns read by source_abs.py under their real names, padded with filler columns to
+roughly the width of the real tables, for about as many areas as the real granularity has.
+Counts are random but consistent (income bins and occupations add up to the population,
+the labour force columns to the labour force), and a few areas have no population.
+
+    python synthetic_datapack.py ~/synthetic --granularity POA SA2 --scale 0.5
+
+The output directory can then be used as dir in config.ini.
+"""
+
+# Areas in each granularity of the 2016 DataPack
+AREA_COUNTS = {'POA': 2670, 'SSC': 15304, 'SA1': 57523, 'SA2': 2310, 'SA3': 358, 'SA4': 107}
+
+# Average population of an area
+AREA_POPULATION = {'POA': 9000, 'SSC': 1500, 'SA1': 420, 'SA2': 10000, 'SA3': 66000, 'SA4': 220000}
+
+# Approximate number of columns of each table, the index column included
+TABLE_WIDTHS = {'G01': 109, 'G02': 9, 'G17A': 201, 'G17B': 201, 'G17C': 141, 'G29': 69, 'G40': 121,
+                'G57A': 201, 'G57B': 201}
+
+# Real columns of a table that source_abs.py does not read, by source frame and table. The
+# stages of earlier versions read them, so they are written for their benchmarks.
+OTHER_COLUMNS = {'qualifications': 'G40'}
+QUALIFICATION_COLS = ['Non_sch_quals_PostGrad_Dgre_P', 'Non_sch_quals_Gr_Dip_Gr_Crt_P', 'Non_sch_quals_Bchelr_Degree_P',
+                      'Non_sch_quls_Advncd_Dip_Dip_P', 'Non_sch_quls_Cert3a4_Level_P', 'Non_sch_quls_Cert1a2_Level_P',
+                      'Non_sch_quls_Certnfd_Level_P', 'Non_sch_quls_CertTot_Level_P']
+
+AGE_GROUPS = ['15_19_yrs', '20_24_yrs', '25_34_yrs', '35_44_yrs', '45_54_yrs', '55_64_yrs', '65_74_yrs',
+              '75_84_yrs', '85ov', 'Tot']
+
+
+def area_codes(granularity, n):
+    # Codes in the format of the DataPack's first column
+    if granularity in ('POA', 'SSC'):
+        width = 4 if granularity == 'POA' else 5
+        return ([granularity + str(i).zfill(width) for i in range(1000, 1000 + n)])
+    width = {'SA1': 7, 'SA2': 9, 'SA3': 5, 'SA4': 3}[granularity]
+    start = 10 ** (width - 1)
+    step = max((9 * start) // n, 1)
+    return ([str(start + i * step) for i in range(n)])
+
+
+def filler_columns(table, n, taken):
+    # Column names in the style of the real table, by sex and age group
+    names = []
+    for sex in ['M', 'F', 'P']:
+        for i in range(n):
+            name = '%s_%s_%s_%s' % (sex, table, i // len(AGE_GROUPS), AGE_GROUPS[i % len(AGE_GROUPS)])
+            if name not in taken:
+                names.append(name)
+            if len(names) == n:
+                return (names)
+    return (names)
+
+
+def split_counts(rng, totals, shares):
+    # Random counts per area and category adding up to totals
+    import numpy as np
+
+    p = rng.dirichlet(shares, size=len(totals))
+    return (np.vstack([rng.multinomial(t, row) for t, row in zip(totals, p)]))
+
+
+def grouped_median(counts, spec):
+    import numpy as np
+
+    cum = counts.cumsum(axis=1)
+    j = (cum >= cum[:, -1:] / 2).argmax(axis=1)
+    return (np.where(cum[:, -1] > 0, np.asarray(bin_values(spec))[j], 0))
+
+
+def source_frames(granularity, n, rng):
+    # The columns read by source_abs.py, by source name, and those of OTHER_COLUMNS
+    import numpy as np
+    import pandas as pd
+
+    population = rng.lognormal(np.log(AREA_POPULATION[granularity]), 0.6, n).astype(int)
+    population[rng.random(n) < 0.01] = 0
+    adults = (population * 0.8).astype(int)
+
+    personal = split_counts(rng, adults, np.linspace(2, 1, len(PERSONAL_INCOME_BINS)) * 5)
+    households = split_counts(rng, (population / 2.5).astype(int), np.ones(len(HOUSEHOLD_INCOME_BINS)) * 5)
+
+    labour_force = (adults * rng.uniform(0.55, 0.7, n)).astype(int)
+    status = split_counts(rng, labour_force, [12, 6, 1, 1])
+    not_in_lf = adults - labour_force
+    employed = labour_force - status[:, 3]
+    occupation = split_counts(rng, employed, [4, 6, 4, 3, 4, 3, 2, 3, 1])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        employment = pd.DataFrame(status, columns=status_cols[:4])
+        employment['lfs_Tot_LF_P'] = labour_force
+        employment['lfs_N_the_labour_force_P'] = not_in_lf
+        employment['Percent_Unem_loyment_P'] = np.round(100 * status[:, 3] / labour_force, 1)
+        employment['Percnt_LabForc_prticipation_P'] = np.round(100 * labour_force / adults, 1)
+        employment['Percnt_Employment_to_populn_P'] = np.round(100 * employed / adults, 1)
+    employment = employment.fillna(0)
+
+    medians = pd.DataFrame({'Median_age_persons': rng.integers(25, 55, n),
+                            'Median_mortgage_repay_monthly': rng.integers(800, 3000, n),
+                            'Median_tot_prsnl_inc_weekly': grouped_median(personal, PERSONAL_INCOME_BINS),
+                            'Median_rent_weekly': rng.integers(150, 700, n),
+                            'Median_tot_fam_inc_weekly': rng.integers(800, 3500, n),
+                            'Average_num_psns_per_bedroom': rng.uniform(0.7, 1.3, n).round(1),
+                            'Median_tot_hhd_inc_weekly': grouped_median(households, HOUSEHOLD_INCOME_BINS),
+                            'Average_household_size': rng.uniform(1.8, 3.4, n).round(1)})
+    medians[population == 0] = 0
+
+    # Non-school qualifications of the adults; the certificate total adds up the certificates
+    qualified = (adults * rng.uniform(0.4, 0.7, n)).astype(int)
+    qualifications = pd.DataFrame(split_counts(rng, qualified, [3, 2, 8, 4, 6, 1, 1]), columns=QUALIFICATION_COLS[:7])
+    qualifications['Non_sch_quls_CertTot_Level_P'] = qualifications[QUALIFICATION_COLS[4:7]].sum(axis=1)
+
+    return ({'personal_income': pd.DataFrame(personal, columns=bin_columns(PERSONAL_INCOME_BINS)),
+             'medians': medians,
+             'household_income': pd.DataFrame(households, columns=bin_columns(HOUSEHOLD_INCOME_BINS)),
+             'occupation': pd.DataFrame(occupation, columns=occu_cols),
+             'population': pd.DataFrame({'Tot_P_P': population}),
+             'employment': employment,
+             'qualifications': qualifications})
+
+
+def write_datapack(datapack_dir, granularity, scale=1.0, seed=0):
+    # Writes every table read by source_abs.py for one granularity and returns the number of areas
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    n = max(int(AREA_COUNTS[granularity] * scale), 10)
+    pack = DataPack(granularity, datapack_dir)
+    os.makedirs(pack.dir, exist_ok=True)
+    frames = source_frames(granularity, n, rng)
+
+    # Multi-part tables (G17A/B/C, G57A/B) get their columns split evenly across the parts
+    columns = {}
+    for name in SOURCES:
+        tables, cols = source_tables(name), SOURCES[name][1]
+        size = -(-len(cols) // len(tables))
+        for i, table in enumerate(tables):
+            part = frames[name][cols[i * size:(i + 1) * size]]
+            columns[table] = pd.concat([columns[table], part], axis=1) if table in columns else part
+    for name, table in OTHER_COLUMNS.items():
+        columns[table] = pd.concat([columns[table], frames[name]], axis=1)
+
+    for table, df in columns.items():
+        df = df.loc[:, ~df.columns.duplicated()]
+        filler = filler_columns(table, max(TABLE_WIDTHS[table] - 1 - df.shape[1], 0), set(df.columns))
+        padding = pd.DataFrame(rng.integers(0, 200, (n, len(filler))), columns=filler)
+        df = pd.concat([df, padding], axis=1)
+        df.insert(0, INDEX_CODES[granularity], area_codes(granularity, n))
+        df.to_csv(pack.dir + pack.file_name(table), index=False)
+    return (n)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic 2016 Census GCP DataPack.')
+    parser.add_argument('datapack_dir', help='directory to write the DataPack to')
+    parser.add_argument('--granularity', nargs='+', choices=sorted(INDEX_CODES), default=sorted(INDEX_CODES),
+                        help='granularities to write (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='number of areas as a fraction of the real DataPack (default: 1)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for gran in args.granularity:
+        n = write_datapack(args.datapack_dir, gran, args.scale, args.seed)
+        print("  %-4s %8d areas" % (gran, n))
+
+
+if __name__ == "__main__":
+    main()
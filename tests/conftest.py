@@ -0,0 +1,19 @@
+# Shared fixtures: small synthetic DataPacks written once per test session
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_datapack import write_datapack
+
+
+@pytest.fixture(scope='session')
+def datapack_dir(tmp_path_factory):
+    # POA and SA1 DataPacks of about a hundred areas each
+    path = str(tmp_path_factory.mktemp('datapack')) + os.sep
+    for granularity, scale in [('POA', 0.05), ('SA1', 0.002)]:
+        write_datapack(path, granularity, scale, seed=0)
+    return (path)
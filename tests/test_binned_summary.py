@@ -0,0 +1,45 @@
+# binned_summary against the original per-area summary(): every person expanded into the
+# value of their bin and described with pandas
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS, bin_columns, bin_values, binned_summary
+
+
+def legacy_summary(counts, values):
+    # The original Load_wkly_prsnl_inc/Load_hhld_wkly_inc loop, one area at a time
+    rows = {}
+    for area, row in counts.iterrows():
+        if row.sum() == 0:
+            rows[area] = [0, 0, 0, 0]
+            continue
+        se = pd.Series(np.repeat(values, row.to_numpy()))
+        info = se.describe()
+        info_norm = ((se - se.min()) / (se.max() - se.min())).describe()
+        rows[area] = [info['std'], info_norm['std'], info['mean'], info_norm['mean']]
+    df = pd.DataFrame.from_dict(rows, orient='index', columns=['std', 'std_norm', 'mean', 'mean_norm'])
+    na = df['std_norm'].isnull()
+    df.loc[na, 'std_norm'] = 0
+    df.loc[na, 'mean_norm'] = df.loc[na, 'mean']
+    return (df.astype(float))
+
+
+@pytest.mark.parametrize('spec', [PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS])
+def test_matches_legacy_summary(spec):
+    columns = bin_columns(spec)
+    rng = np.random.default_rng(0)
+    counts = pd.DataFrame(rng.integers(0, 50, (20, len(columns))), columns=columns,
+                          index=['area%d' % i for i in range(20)])
+    counts.iloc[0] = 0                 # no counts at all
+    counts.iloc[1] = 0
+    counts.iloc[1, 3] = 1              # a single person
+    counts.iloc[2] = 0
+    counts.iloc[2, 5] = 40             # everyone in a single bin
+    counts.iloc[3] = 0
+    counts.iloc[3, [0, -1]] = [1, 1]   # only the lowest and highest bins
+    counts.iloc[4, :7] = 0             # sparse lower bins
+
+    expected = legacy_summary(counts, bin_values(spec))
+    pd.testing.assert_frame_equal(binned_summary(counts, bin_values(spec)), expected, check_exact=False, rtol=1e-9)
@@ -0,0 +1,80 @@
+# The parsed-table cache: what its keys depend on, reuse across runs and LRU eviction
+
+import os
+
+import pandas as pd
+
+from source_abs import DataPack, SOURCES, cache_key, trim_cache, clear_cache, add_event_sink, remove_event_sink
+
+
+def read_origins(pack, name):
+    # (frame, origin of every table read) of a source read through pack
+    origins = []
+    sink = add_event_sink(lambda event: origins.append(event['origin']) if event['event'] == 'read' else None)
+    try:
+        df = pack.read_source(name)
+    finally:
+        remove_event_sink(sink)
+    return (df, origins)
+
+
+def test_key_follows_file_columns_and_dtypes(tmp_path):
+    path = tmp_path / 'table.csv'
+    path.write_text('code,a,b\n1,2,3\n')
+    key = cache_key(str(path), '', {'code', 'a'}, {'code': str})
+    assert cache_key(str(path), '', {'a', 'code'}, {'code': str}) == key
+    assert cache_key(str(path), '', {'code', 'a'}, {'code': str}, 'arrow') == key  # same frame
+    assert cache_key(str(path), '', {'code', 'a'}, {'code': str}, 'arrow_dtypes') != key
+    assert cache_key(str(path), '', {'code', 'a', 'b'}, {'code': str}) != key
+    assert cache_key(str(path), '', {'code', 'a'}, {'code': str, 'a': 'int64'}) != key
+    assert cache_key(str(path), 'member.csv', {'code', 'a'}, {'code': str}) != key
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert cache_key(str(path), '', {'code', 'a'}, {'code': str}) != key
+
+
+def test_reused_across_runs_until_the_table_changes(datapack_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    parsed, origins = read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir), 'population')
+    assert origins == ['source']
+    cached, origins = read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir), 'population')
+    assert origins == ['cache']
+    pd.testing.assert_frame_equal(cached, parsed)
+
+    # A changed DataPack table is parsed again
+    source = DataPack('POA', datapack_dir).source(SOURCES['population'][0])[0]
+    st = os.stat(source)
+    try:
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        _, origins = read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir), 'population')
+        assert origins == ['source']
+    finally:
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # --no-cache neither reads nor writes entries
+    entries = sorted(os.listdir(cache_dir))
+    _, origins = read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir, cache=False), 'medians')
+    assert origins == ['source'] and sorted(os.listdir(cache_dir)) == entries
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # Five 1 kB entries, a.pkl used longest ago; a limit of 3 kB keeps the three used last
+    for i, name in enumerate('abcde'):
+        path = tmp_path / (name + '.pkl')
+        path.write_bytes(b'x' * 1024)
+        os.utime(path, (1000 + i, 1000 + i))
+    os.utime(tmp_path / 'a.pkl', (2000, 2000))  # a cache hit touches its entry
+    trim_cache(str(tmp_path), 3 / 1024)
+    assert sorted(os.listdir(tmp_path)) == ['a.pkl', 'd.pkl', 'e.pkl']
+
+    clear_cache(str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_cache_hit_is_marked_used(datapack_dir, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir), 'population')
+    entry = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    os.utime(entry, (1000, 1000))
+    read_origins(DataPack('POA', datapack_dir, cache_dir=cache_dir), 'population')
+    assert os.path.getmtime(entry) > 1000
@@ -0,0 +1,159 @@
+# A census spec mapping renamed tables and columns back to the 2016 ones gives the 2016 features
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import (DataPack, SOURCES, BIN_SPECS, bin_columns, bin_values, build_features, build_panel,
+                        read_census_spec, panel_frame, source_tables, add_event_sink, remove_event_sink)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SPEC = """[census]
+year = 2021
+path = {year} Census GCP All Geographies for AUS/{granularity}/AUS/
+dir = %s
+
+[tables]
+G29 = G33
+G57A = G60
+G57B = G60
+
+[columns]
+P_3000_more_Tot = P_3000_3499_Tot P_3500_more_Tot
+Tot_P_P = Tot_Persons
+"""
+
+
+def renamed_datapack(datapack_dir, tmp_path):
+    # The POA tables of datapack_dir under other names: G29 as G33, G57A and G57B merged into
+    # G60, the top income bin split in two and Tot_P_P renamed
+    pack = DataPack('POA', datapack_dir)
+    target = tmp_path / '2021 Census GCP All Geographies for AUS' / 'POA' / 'AUS'
+    os.makedirs(target)
+    tables = {table: pd.read_csv(pack.source(table)[0], dtype={pack.index_code: str})
+              for table in ['G01', 'G02', 'G17A', 'G17B', 'G17C', 'G29', 'G40', 'G57A', 'G57B']}
+    tables['G57A'] = tables['G57A'].merge(tables.pop('G57B'), on=pack.index_code, suffixes=('', '_B'))
+    for table, df in tables.items():
+        df = df.rename(columns={pack.index_code: 'POA_CODE_2021', 'Tot_P_P': 'Tot_Persons'})
+        if 'P_3000_more_Tot' in df:
+            top = df.pop('P_3000_more_Tot')
+            df = pd.concat([df, pd.DataFrame({'P_3000_3499_Tot': top // 2, 'P_3500_more_Tot': top - top // 2})],
+                           axis=1)
+        name = {'G29': 'G33', 'G57A': 'G60'}.get(table, table)
+        df.to_csv(target / ('2021Census_' + name + '_AUS_POA.csv'), index=False)
+    spec = tmp_path / 'census_2021.ini'
+    spec.write_text(SPEC % (str(tmp_path) + os.sep))
+    return (str(spec))
+
+
+def census_datapack(datapack_dir, target_dir, path):
+    # The POA tables of datapack_dir laid out as the census spec at path has them: tables, index
+    # code and columns renamed, columns mapped to several split up and the counts of the census's
+    # own bins drawn at random. Returns the census and the counts of its bins by source.
+    census = read_census_spec(path)
+    source_pack, pack = DataPack('POA', datapack_dir), DataPack('POA', str(target_dir), census=census)
+    rng = np.random.default_rng(int(census['year']))
+    renames = {col: names[0] for col, names in census['columns'].items() if len(names) == 1}
+    tables, bins = {}, {}
+    for name in SOURCES:
+        for table in source_tables(name):
+            df = pd.read_csv(source_pack.source(table)[0], dtype={source_pack.index_code: str})
+            df = df.rename(columns={source_pack.index_code: pack.index_code})
+            if name in census['bins']:
+                df = df.drop(columns=bin_columns(BIN_SPECS[name]), errors='ignore')
+                if name not in bins:
+                    counts = pd.DataFrame(rng.integers(0, 50, size=(len(df), len(census['bins'][name]))),
+                                          columns=bin_columns(census['bins'][name]))
+                    df = pd.concat([df, counts], axis=1)
+                    bins[name] = counts.set_axis(df[pack.index_code])
+            for col, names in census['columns'].items():
+                if col in df and len(names) > 1:
+                    top = df.pop(col)
+                    df = pd.concat([df, pd.DataFrame({names[0]: top // 2, names[1]: top - top // 2})], axis=1)
+            df = df.rename(columns=renames)
+            file_name = pack.file_name(table)
+            if file_name in tables:
+                df = tables[file_name].merge(df[[pack.index_code] + [col for col in df if col not in tables[file_name]]],
+                                             on=pack.index_code)
+            tables[file_name] = df
+    os.makedirs(pack.dir, exist_ok=True)
+    for file_name, df in tables.items():
+        df.to_csv(pack.dir + file_name, index=False)
+    return (census, bins)
+
+
+def parsed_tables(census, datapack_dir):
+    # Features built with census, and the tables parsed for them
+    reads = []
+    sink = add_event_sink(lambda event: reads.append(event['name']) if event.get('origin') == 'source' else None)
+    try:
+        result = build_features('POA', datapack_dir, cache=False, compact=False, census=census)
+    finally:
+        remove_event_sink(sink)
+    return (result, reads)
+
+
+def test_census_spec_gives_2016_features(datapack_dir, tmp_path):
+    census = read_census_spec(renamed_datapack(datapack_dir, tmp_path))
+    result, reads = parsed_tables(census, census['dir'])
+    expected = build_features('POA', datapack_dir, cache=False, compact=False)
+
+    assert list(result.columns[1:]) == list(expected.columns[1:])
+    pd.testing.assert_frame_equal(result.iloc[:, 1:], expected.iloc[:, 1:])
+    assert sorted(reads) == sorted(set(reads)) and len(reads) == 8  # every table parsed once
+
+
+def test_panel_layouts(datapack_dir):
+    df = build_features('POA', datapack_dir, cache=False, compact=False)
+    long = panel_frame({'2016': df, '2021': df}, 'POA', 'long')
+    assert list(long.columns[:2]) == ['POA_CODE', 'year'] and len(long) == 2 * len(df)
+    wide = panel_frame({'2016': df, '2021': df}, 'POA', 'wide')
+    assert len(wide) == len(df)
+    assert (wide['population_2016'] == wide['population_2021']).all()
+    assert list(wide.columns[1:3]) == ['population_2016', 'population_2021']
+
+
+@pytest.mark.parametrize('year, tables', [('2011', 7), ('2016', 9), ('2021', 9)])
+def test_shipped_census_specs(datapack_dir, tmp_path, year, tables):
+    census, bins = census_datapack(datapack_dir, tmp_path, os.path.join(ROOT, 'census_' + year + '.ini'))
+    result, reads = parsed_tables(census, str(tmp_path))
+    expected = build_features('POA', datapack_dir, cache=False, compact=False)
+    assert sorted(reads) == sorted(set(reads)) and len(reads) == tables
+    assert list(result.columns[1:]) == list(expected.columns[1:])
+
+    medians = ['median_personal_weekly_income', 'hhld_weekly_income_median']
+    binned = [col for col in expected.columns if 'income' in col and col not in medians]
+    if not bins:
+        pd.testing.assert_frame_equal(result.iloc[:, 1:], expected.iloc[:, 1:])
+        return
+    others = [col for col in expected.columns[1:] if col not in binned]
+    pd.testing.assert_frame_equal(result[others], expected[others])
+    # the income statistics come from the census's own bins
+    counts = bins['personal_income'].loc[result.iloc[:, 0]]
+    mean = counts.to_numpy() @ bin_values(census['bins']['personal_income']) / counts.sum(axis=1).to_numpy()
+    assert np.allclose(result['mean_personal_weekly_income'], mean)
+    assert set(result['median_personal_weekly_income_interval'].dropna()) <= {
+        row[1] for row in census['bins']['personal_income']}
+
+
+def test_panel_of_shipped_specs(datapack_dir, tmp_path):
+    specs = [os.path.join(ROOT, 'census_' + year + '.ini') for year in ('2011', '2016', '2021')]
+    for path in specs:
+        census_datapack(datapack_dir, tmp_path, path)
+    panel = build_panel(specs, 'POA', str(tmp_path), cache=False, compact=False)
+    assert sorted(panel['year'].unique()) == [2011, 2016, 2021]
+    assert os.path.exists(str(tmp_path / 'features_by_POA_panel.csv'))
+
+
+@pytest.mark.parametrize('bins, message', [('wages =\n    P_1_Tot 1 1 1 1', 'must be one of'),
+                                           ('personal_income =\n    P_1_Tot 1 1 1', 'needs lines of'),
+                                           ('personal_income =\n    P_2_Tot 2 2 2 2\n    P_1_Tot 1 1 1 1',
+                                            'increasing order')])
+def test_census_spec_bins_are_checked(tmp_path, bins, message):
+    path = tmp_path / 'census.ini'
+    path.write_text('[census]\nyear = 2011\n\n[bins]\n' + bins + '\n')
+    with pytest.raises(ValueError, match=message):
+        read_census_spec(str(path))
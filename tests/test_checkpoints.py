@@ -0,0 +1,88 @@
+# Stage checkpoints: what invalidates them, --force, and the code in every fingerprint
+
+import inspect
+import os
+
+import pandas as pd
+import pytest
+
+import source_abs
+from source_abs import DataPack, PIPELINE, build_features, add_event_sink, remove_event_sink
+
+# Called by the stages without shaping their output
+INSTRUMENTATION = {source_abs.measured, source_abs.emit_event, source_abs.cache_key, source_abs.part_size,
+                   source_abs.trim_cache}
+
+
+def called(func):
+    # Functions of source_abs (and methods of DataPack) that func refers to by name
+    names = set(func.__code__.co_names)
+    for const in func.__code__.co_consts:
+        if inspect.iscode(const):
+            names |= set(const.co_names)
+    found = set()
+    for name in names:
+        for obj in (getattr(source_abs, name, None), getattr(DataPack, name, None)):
+            if inspect.isfunction(obj) and obj.__module__ == 'source_abs':
+                found.add(obj)
+    return (found)
+
+
+@pytest.mark.parametrize('name', list(PIPELINE))
+def test_fingerprint_covers_called_code(name):
+    node = PIPELINE[name]
+    fingerprinted = {id(obj) for obj in node['code']} | {id(node['func'])}
+    seen, todo = set(), [node['func']]
+    while todo:
+        func = todo.pop()
+        if func in seen or func in INSTRUMENTATION:
+            continue
+        seen.add(func)
+        todo += called(func)
+    assert sorted(func.__qualname__ for func in seen if id(func) not in fingerprinted) == []
+
+
+def computed(datapack_dir, checkpoint_dir, **options):
+    # (features, stages computed rather than loaded from their checkpoint)
+    stages = []
+    sink = add_event_sink(lambda event: stages.append(event['name']) if event['event'] == 'stage' else None)
+    try:
+        df = build_features('POA', datapack_dir, cache=False, compact=False, checkpoint_dir=checkpoint_dir,
+                            **options)
+    finally:
+        remove_event_sink(sink)
+    return (df, sorted(stages))
+
+
+def test_only_changed_stages_recompute(datapack_dir, tmp_path, monkeypatch):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    expected, stages = computed(datapack_dir, checkpoint_dir)
+    assert stages == sorted(PIPELINE)
+    df, stages = computed(datapack_dir, checkpoint_dir)
+    assert stages == []
+    pd.testing.assert_frame_equal(df, expected)
+
+    # A changed table recomputes the stages reading it
+    source = DataPack('POA', datapack_dir).source('G40')[0]
+    st = os.stat(source)
+    try:
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        assert computed(datapack_dir, checkpoint_dir)[1] == ['employment', 'features']
+    finally:
+        os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert computed(datapack_dir, checkpoint_dir)[1] == ['employment', 'features']
+
+    # So does changed code
+    monkeypatch.setitem(PIPELINE['household_income'], 'code', PIPELINE['household_income']['code'] + ['changed'])
+    assert computed(datapack_dir, checkpoint_dir)[1] == ['features', 'household_income']
+    # and other filters only the final join
+    assert computed(datapack_dir, checkpoint_dir, filters=[])[1] == ['features']
+
+
+def test_force(datapack_dir, tmp_path):
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    computed(datapack_dir, checkpoint_dir)
+    assert computed(datapack_dir, checkpoint_dir, force=['medians'])[1] == ['features', 'medians']
+    assert computed(datapack_dir, checkpoint_dir, force=['all'])[1] == sorted(PIPELINE)
+    with pytest.raises(ValueError, match='Unknown stage'):
+        computed(datapack_dir, checkpoint_dir, force=['median'])
@@ -0,0 +1,40 @@
+# Compact dtypes: smaller frames holding the same values
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import build_features, compact_features, compact_codes, similarity_columns
+
+
+@pytest.mark.parametrize('granularity', ['POA', 'SA1'])
+def test_compact_keeps_values(datapack_dir, granularity):
+    df = build_features(granularity, datapack_dir, cache=False, compact=False)
+    compact = compact_features(df, df.columns[0])
+    assert compact.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum()
+    code = df.columns[0]
+    assert compact[code].memory_usage(deep=True) <= df[code].memory_usage(deep=True)
+    assert (compact[code].astype(str).to_numpy() == df[code].to_numpy()).all()
+
+    ratios = similarity_columns(df)
+    for col in df.columns[1:]:
+        if col in ratios:
+            assert compact[col].dtype == 'float32'
+            assert np.allclose(compact[col], df[col], rtol=1e-6, equal_nan=True)
+        elif df[col].dtype == 'float64':
+            # means, medians and stds keep every digit
+            pd.testing.assert_series_equal(compact[col], df[col])
+        elif pd.api.types.is_integer_dtype(df[col]):
+            assert (compact[col] == df[col]).all() and compact[col].dtype.itemsize <= df[col].dtype.itemsize
+        else:
+            assert compact[col].dtype == 'category'
+            pd.testing.assert_series_equal(compact[col].astype(object), df[col].astype(object))
+
+
+@pytest.mark.parametrize('codes, integer', [(['1100701', '1100702'], True), (['0800', '2000'], False),
+                                            (['POA2000', 'POA2001'], False)])
+def test_codes(codes, integer):
+    # Leading zeros or letters would not survive as integers
+    compact = compact_codes(pd.Series(codes))
+    assert pd.api.types.is_integer_dtype(compact) == integer
+    assert compact.astype(str).tolist() == codes
@@ -0,0 +1,76 @@
+# Events of the stages and table reads, their sinks and their memory peaks
+
+import json
+import os
+import tracemalloc
+import warnings
+
+import numpy as np
+import pytest
+
+import source_abs
+from source_abs import PIPELINE, build_features, measured, add_event_sink, remove_event_sink
+
+
+@pytest.fixture
+def events():
+    received = []
+    sink = add_event_sink(received.append)
+    yield received
+    remove_event_sink(sink)
+
+
+def test_stage_and_read_events(datapack_dir, tmp_path, events):
+    path = str(tmp_path / 'events.jsonl')
+    df = build_features('POA', datapack_dir, cache=False, compact=False, events=path)
+
+    stages = {event['name']: event for event in events if event['event'] == 'stage'}
+    assert sorted(stages) == sorted(PIPELINE)
+    assert stages['features']['rows_out'] == len(df)
+    assert all(event['wall_s'] >= 0 and event['cpu_s'] >= 0 for event in stages.values())
+    reads = [event for event in events if event['event'] == 'read']
+    parsed = [event for event in reads if event['origin'] == 'source']
+    assert len(parsed) == 9 and all(event['bytes_read'] > 0 and event['rows_out'] for event in parsed)
+    # G02 feeds three stages but is parsed once; the stages' reads add up its rows
+    assert stages['medians']['rows_in'] == stages['medians']['rows_out']
+
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    # stages run in threads, so the file may list them in another order
+    assert sorted((line['event'], line['name']) for line in lines) == \
+        sorted((event['event'], event['name']) for event in events)
+
+
+def test_warnings_are_events(events, monkeypatch):
+    monkeypatch.setattr(source_abs, 'show_warning', lambda *args: None)
+    with warnings.catch_warnings():
+        warnings.simplefilter('always')
+        monkeypatch.setattr(warnings, 'showwarning', source_abs.warning_event)
+        with measured('stage', 'warned', 'POA'):
+            warnings.warn('a hidden copy', RuntimeWarning)
+    warning = next(event for event in events if event['event'] == 'warning')
+    assert warning['name'] == 'RuntimeWarning' and warning['during'] == 'warned'
+
+
+def test_traced_peak_is_that_of_the_block(events):
+    tracemalloc.start()
+    try:
+        held = np.ones(2 ** 22)  # 32 MB traced before any block starts
+        with measured('stage', 'outer', 'POA'):
+            with measured('read', 'large', 'POA'):
+                np.ones(2 ** 21).sum()  # 16 MB, freed again
+            with measured('read', 'small', 'POA'):
+                pass
+    finally:
+        tracemalloc.stop()
+    peaks = {event['name']: event['traced_peak_mb'] for event in events}
+    assert 16 <= peaks['large'] < 17
+    assert peaks['small'] < 1
+    assert 16 <= peaks['outer'] < 17
+    del held
+
+
+def test_profile_dumps(datapack_dir, tmp_path):
+    profile_dir = str(tmp_path / 'profiles')
+    build_features('POA', datapack_dir, cache=False, compact=False, profile_dir=profile_dir)
+    assert sorted(os.listdir(profile_dir)) == sorted('POA_' + name + '.prof' for name in PIPELINE)
@@ -0,0 +1,147 @@
+# The feature service: lookups, the HTTP handler and reloads of rewritten files
+
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import feature_service
+from feature_service import FeatureStore, make_handler
+from source_abs import build_features, write_features, feature_file
+
+
+@pytest.fixture(scope='module')
+def features(datapack_dir):
+    return (build_features('POA', datapack_dir, cache=False, compact=False).reset_index(drop=True))
+
+
+@pytest.fixture
+def store(features, tmp_path):
+    write_features(features, str(tmp_path / 'features_by_POA'), features.columns[0], ['csv'])
+    return (FeatureStore(str(tmp_path), ['POA']))
+
+
+def test_lookups(features, store):
+    code = features.iloc[0, 0]
+    assert store.get('POA', code, ['population']) == {'population': int(features.loc[0, 'population'])}
+    assert store.get('POA', 'nowhere') is None
+    result = store.lookup('POA', [code, 'nowhere'], ['population', 'median_age_persons'])
+    assert list(result['features']) == [code] and result['missing'] == ['nowhere']
+    assert list(store.frame('POA', features.iloc[:3, 0]).index) == list(features.iloc[:3, 0])
+    with pytest.raises(KeyError, match='Unknown column'):
+        store.lookup('POA', [code], ['no_such_feature'])
+    with pytest.raises(KeyError, match='No features loaded for SA1'):
+        store.lookup('SA1', [code])
+
+
+def request(url, body=None):
+    # (status, JSON answer) of a GET, or of a POST of body
+    data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data)) as response:
+            return (response.status, json.loads(response.read()))
+    except urllib.error.HTTPError as e:
+        return (e.code, json.loads(e.read()))
+
+
+def test_http(features, store):
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(store))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    code, other = features.iloc[0, 0], features.iloc[1, 0]
+    population = int(features.loc[0, 'population'])
+    try:
+        assert request(url + '/features/POA/' + code + '?columns=population') == (200, {'population': population})
+        status, answer = request(url + '/features/POA?codes=' + code + ',nowhere&columns=population')
+        assert status == 200 and answer == {'features': {code: {'population': population}}, 'missing': ['nowhere']}
+        status, answer = request(url + '/features/POA', {'codes': [code, other], 'columns': ['population']})
+        assert status == 200 and list(answer['features']) == [code, other]
+        assert request(url + '/health')[1]['POA']['areas'] == len(features)
+
+        assert request(url + '/features/POA/nowhere')[0] == 404
+        assert request(url + '/features/SA1/' + code)[0] == 404
+        assert request(url + '/features/POA/' + code + '?columns=no_such_feature')[0] == 404
+        assert request(url + '/nothing')[0] == 404
+        assert request(url + '/features/POA', b'not json')[0] == 400
+        assert request(url + '/features/POA', [code])[0] == 400
+        assert request(url + '/features/POA', {'codes': code})[0] == 400
+        assert request(url + '/features/POA', {'codes': [code], 'columns': [1]})[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_feature_file_prefers_latest_build(features, tmp_path):
+    base = str(tmp_path / 'features_by_POA')
+    write_features(features, base, features.columns[0], ['csv', 'npy'])
+    assert feature_file(str(tmp_path), 'POA') == base + '.npy'
+    time.sleep(0.01)
+    write_features(features.iloc[:10], base, features.columns[0], ['csv'])
+    assert feature_file(str(tmp_path), 'POA') == base + '.csv'
+    assert feature_file(str(tmp_path), 'SA1') is None
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'npy'])
+def test_reload_during_a_write(features, tmp_path, monkeypatch, fmt):
+    # A poll while the new files are being moved into place still serves the old table whole
+    base = str(tmp_path / 'features_by_POA')
+    write_features(features, base, features.columns[0], [fmt])
+    store = FeatureStore(str(tmp_path), ['POA'])
+    replace = os.replace
+    served = []
+
+    def replacing(source, target):
+        store.reload()
+        served.append(len(store.table('POA').index))
+        replace(source, target)
+
+    time.sleep(0.01)
+    monkeypatch.setattr(os, 'replace', replacing)
+    write_features(features.iloc[:10], base, features.columns[0], [fmt])
+    monkeypatch.setattr(os, 'replace', replace)
+    assert served and set(served) <= {len(features), 10}
+    assert served[0] == len(features)
+    store.reload()
+    assert len(store.table('POA').index) == 10
+
+
+def test_write_finishing_during_a_load_is_reloaded(features, tmp_path, monkeypatch):
+    # The file is replaced after it was read but before the load completes
+    base = str(tmp_path / 'features_by_POA')
+    write_features(features, base, features.columns[0])
+    store = FeatureStore(str(tmp_path), ['POA'])
+    read_features = feature_service.read_features
+
+    def reading(path, columns=None):
+        df = read_features(path, columns)
+        time.sleep(0.01)
+        write_features(features.iloc[:10], base, features.columns[0])
+        return (df)
+
+    monkeypatch.setattr(feature_service, 'read_features', reading)
+    time.sleep(0.01)
+    write_features(features.iloc[:20], base, features.columns[0])
+    assert store.reload() == ['POA'] and len(store.table('POA').index) == 20
+    monkeypatch.setattr(feature_service, 'read_features', read_features)
+    assert store.reload() == ['POA'] and len(store.table('POA').index) == 10
+
+
+def test_polling(features, tmp_path):
+    base = str(tmp_path / 'features_by_POA')
+    write_features(features, base, features.columns[0])
+    store = FeatureStore(str(tmp_path), ['POA'], poll_seconds=0.02)
+    try:
+        time.sleep(0.01)
+        write_features(features.iloc[:10], base, features.columns[0])
+        deadline = time.time() + 5
+        while len(store.table('POA').index) != 10 and time.time() < deadline:
+            time.sleep(0.02)
+        assert len(store.table('POA').index) == 10
+    finally:
+        store.stop_polling.set()
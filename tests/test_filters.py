@@ -0,0 +1,40 @@
+# Row filters and key checks of the joined tables
+
+import os
+
+import pandas as pd
+import pytest
+
+from source_abs import ROW_FILTERS, build_features, check_keys, clean_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def built(datapack_dir, **options):
+    return (build_features('POA', datapack_dir, cache=False, compact=False, **options))
+
+
+@pytest.mark.parametrize('filters', [[], ['zero_labour_force']])
+def test_spec_applies_filters(datapack_dir, filters):
+    expected = built(datapack_dir, filters=filters)
+    result = built(datapack_dir, spec=os.path.join(ROOT, 'features.ini'), filters=filters)
+    assert result.to_csv(index=False) == expected.to_csv(index=False)
+
+
+def test_filters_drop_matching_areas(datapack_dir):
+    everything = built(datapack_dir, filters=[])
+    for name, (column, condition) in ROW_FILTERS.items():
+        match = everything[column].isna() if condition == 'missing' else everything[column] == 0
+        df = built(datapack_dir, filters=[name])
+        pd.testing.assert_frame_equal(df, everything[~match])
+    pd.testing.assert_frame_equal(built(datapack_dir), everything[everything['population'] != 0])
+    with pytest.raises(ValueError, match='Unknown filter'):
+        clean_up(everything, everything.columns[0], ['zero'])
+
+
+def test_key_checks():
+    a, b = pd.Index(['1', '2', '3']), pd.Index(['2', '3', '4'])
+    assert check_keys({'A': a, 'B': b}) == {'A': 1, 'B': 1}
+    assert check_keys({'A': a, 'B': a}) == {}
+    with pytest.raises(ValueError, match='appear more than once in B'):
+        check_keys({'A': a, 'B': pd.Index(['1', '1', '2'])})
@@ -0,0 +1,42 @@
+# Grouped percentiles and Gini coefficients of the income bins
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS, bin_columns, bin_midpoints, binned_inequality
+
+
+@pytest.mark.parametrize('spec', [PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS])
+def test_midpoints_lie_in_their_bins(spec):
+    lower = [row[2] for row in spec]
+    for i, midpoint in enumerate(bin_midpoints(spec)[:-1]):
+        assert lower[i] <= midpoint < lower[i + 1]
+    assert bin_midpoints(spec)[-1] == lower[-1]
+
+
+def test_percentiles_interpolate_inside_the_bin():
+    # 100 people in 650_799, 100 in 800_999
+    counts = pd.DataFrame([[0] * 14], columns=bin_columns(PERSONAL_INCOME_BINS))
+    counts[['P_650_799_Tot', 'P_800_999_Tot']] = 100
+    df = binned_inequality(counts, PERSONAL_INCOME_BINS).iloc[0]
+    assert df['p10'] == pytest.approx(650 + 0.2 * 150)
+    assert df['grouped_median'] == pytest.approx(800)
+    assert df['p75'] == pytest.approx(800 + 0.5 * 200)
+    assert df['iqr'] == pytest.approx(900 - 725)
+
+
+@pytest.mark.parametrize('spec', [PERSONAL_INCOME_BINS, HOUSEHOLD_INCOME_BINS])
+def test_gini_of_people_at_the_midpoints(spec):
+    columns = bin_columns(spec)
+    rng = np.random.default_rng(0)
+    counts = pd.DataFrame(rng.integers(0, 30, (10, len(columns))), columns=columns)
+    counts.iloc[0] = 0  # no counts at all
+    counts.iloc[1] = 0
+    counts.iloc[1, 6] = 25  # everyone in one bin
+
+    result = binned_inequality(counts, spec)['gini']
+    for area, row in counts.iterrows():
+        x = np.repeat(np.asarray(bin_midpoints(spec), dtype=float), row.to_numpy())
+        expected = np.abs(x[:, None] - x[None]).sum() / (2 * len(x) ** 2 * x.mean()) if len(x) else 0
+        assert result[area] == pytest.approx(expected)
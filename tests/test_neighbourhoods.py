@@ -0,0 +1,62 @@
+# Neighbourhood averages from the KD-tree against brute-force great-circle distances
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import EARTH_RADIUS_KM, neighbourhood_features
+
+pytest.importorskip('scipy')
+
+
+@pytest.fixture
+def areas():
+    rng = np.random.default_rng(0)
+    n = 200
+    df = pd.DataFrame({'code': ['A%d' % i for i in range(n)], 'population': rng.integers(0, 5000, n),
+                       'income': rng.normal(1000, 200, n), 'rate': rng.random(n)})
+    df.loc[::17, 'income'] = np.nan
+    centroids = pd.DataFrame({'latitude': -33.8 + rng.normal(0, 0.2, n), 'longitude': 151 + rng.normal(0, 0.2, n)},
+                             index=pd.Index(df['code'], name='code')).iloc[5:]  # 5 areas without a centroid
+    return (df, centroids)
+
+
+def brute_force(df, centroids, mask_of, weight):
+    located = df[df['code'].isin(centroids.index)]
+    lat = np.radians(centroids.loc[located['code'], 'latitude'].to_numpy())
+    lon = np.radians(centroids.loc[located['code'], 'longitude'].to_numpy())
+    haversine = (np.sin((lat[:, None] - lat[None]) / 2) ** 2 +
+                 np.cos(lat[:, None]) * np.cos(lat[None]) * np.sin((lon[:, None] - lon[None]) / 2) ** 2)
+    mask = mask_of(2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(haversine)))
+    w = located[weight].to_numpy(dtype=float) if weight else np.ones(len(located))
+    result = {}
+    for col in ['income', 'rate']:
+        v = located[col].to_numpy()
+        ok = np.isfinite(v)
+        with np.errstate(invalid='ignore'):
+            average = (mask * (w * np.where(ok, v, 0))[None]).sum(1) / (mask * (w * ok)[None]).sum(1)
+        result[col] = pd.Series(average, index=located.index)
+    return (result)
+
+
+def nearest(k):
+    def mask_of(distance):
+        mask = np.zeros_like(distance)
+        np.put_along_axis(mask, np.argsort(distance, axis=1, kind='stable')[:, :k], 1, axis=1)
+        return (mask)
+    return (mask_of)
+
+
+@pytest.mark.parametrize('weight', ['population', None])
+def test_matches_brute_force(areas, weight):
+    df, centroids = areas
+    result = neighbourhood_features(df, centroids, ['income', 'rate'], k=(1, 5), radius_km=(7.5,), weight=weight,
+                                    batch_rows=37)
+    for suffix, mask_of in [('_knn5', nearest(5)), ('_r7.5km', lambda d: (d <= 7.5).astype(float))]:
+        expected = brute_force(df, centroids, mask_of, weight)
+        for col in ['income', 'rate']:
+            located = result[col + suffix].loc[expected[col].index]
+            assert np.allclose(located, expected[col], equal_nan=True)
+    assert result.loc[:4, ['income_knn5', 'rate_r7.5km']].isna().all().all()
+    located = result.iloc[5:]
+    assert np.allclose(located['rate_knn1'], located['rate'])
@@ -0,0 +1,45 @@
+# Features files: round trips through every format
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import build_features, compact_features, write_features, read_features
+
+
+@pytest.fixture(scope='module')
+def features(datapack_dir):
+    return (build_features('POA', datapack_dir, cache=False, compact=False).reset_index(drop=True))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_npy_round_trip(features, tmp_path, compact):
+    df = compact_features(features, features.columns[0]) if compact else features
+    write_features(df, str(tmp_path / 'features_by_POA'), df.columns[0], ['npy'])
+    pd.testing.assert_frame_equal(read_features(str(tmp_path / 'features_by_POA.npy')), df)
+
+
+def test_npy_columns_are_contiguous(features, tmp_path):
+    # Each column is one run of the file, so loading a few columns reads only their pages
+    write_features(features, str(tmp_path / 'features_by_POA'), features.columns[0], ['npy'])
+    matrix = np.load(str(tmp_path / 'features_by_POA.npy'), mmap_mode='r')
+    assert matrix.flags.f_contiguous and matrix[:, 3].flags.c_contiguous
+    columns = ['population', 'pct_unemployment']
+    pd.testing.assert_frame_equal(read_features(str(tmp_path / 'features_by_POA.npy'), columns),
+                                  features[[features.columns[0]] + columns])
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+def test_arrow_round_trip(features, tmp_path, fmt):
+    pytest.importorskip('pyarrow', exc_type=ImportError)
+    path = str(tmp_path / ('features_by_POA.' + fmt))
+    write_features(features, str(tmp_path / 'features_by_POA'), features.columns[0], [fmt])
+    pd.testing.assert_frame_equal(read_features(path), features)
+    pd.testing.assert_frame_equal(read_features(path, ['population']), features[[features.columns[0], 'population']])
+
+
+def test_csv_round_trip(features, tmp_path):
+    write_features(features, str(tmp_path / 'features_by_POA'), features.columns[0])
+    # csv keeps no dtypes: the interval labels come back as text
+    expected = features.astype({col: object for col in features.columns if features[col].dtype == 'category'})
+    pd.testing.assert_frame_equal(read_features(str(tmp_path / 'features_by_POA.csv')), expected)
@@ -0,0 +1,32 @@
+# Every CSV reader gives the C reader's tables and features
+
+import pandas as pd
+import pytest
+
+from source_abs import DataPack, SOURCES, READERS, build_features, parse_part, source_tables
+
+pytest.importorskip('pyarrow', exc_type=ImportError)
+
+
+@pytest.mark.parametrize('reader', [name for name in READERS if name != 'c'])
+@pytest.mark.parametrize('granularity', ['POA', 'SA1'])
+def test_tables_match_c_reader(datapack_dir, granularity, reader):
+    pack = DataPack(granularity, datapack_dir, cache=False)
+    for name, (_, cols, dtypes) in SOURCES.items():
+        wanted, dtype = pack.column_spec(cols, dtypes)
+        for table in source_tables(name):
+            source, member = pack.source(table)
+            expected = parse_part(source, member, granularity, wanted, dtype, 'c')
+            df = parse_part(source, member, granularity, wanted, dtype, reader)
+            if reader == 'arrow_dtypes':
+                # the codes stay Arrow strings; the values and every other dtype are the same
+                assert isinstance(df[pack.index_code].dtype, pd.ArrowDtype)
+                df[pack.index_code] = df[pack.index_code].astype(object)
+            pd.testing.assert_frame_equal(df, expected)
+
+
+@pytest.mark.parametrize('reader', [name for name in READERS if name != 'c'])
+def test_features_match_c_reader(datapack_dir, reader):
+    expected = build_features('POA', datapack_dir, cache=False, compact=False)
+    df = build_features('POA', datapack_dir, cache=False, compact=False, reader=reader)
+    assert df.to_csv(index=False) == expected.to_csv(index=False)
@@ -0,0 +1,58 @@
+# SA1 counts rolled up the ASGS hierarchy add up, and no area is silently left out
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import source_abs
+from source_abs import SOURCES, INDEX_CODES, build_rollup, aggregate_sources
+
+# Parents of every SA1 area by level, as numbers of SA1 areas per parent
+GROUPS = {'SA2': 4, 'SA3': 12, 'SA4': 40}
+
+
+def concordance(datapack_dir, tmp_path, codes=None):
+    # SA1 codes grouped into made-up parents, in the layout of the ASGS allocation file
+    raw = source_abs.DataPack('SA1', datapack_dir, cache=False).read_source('population')
+    codes = raw.index if codes is None else codes
+    path = str(tmp_path / 'concordance.csv')
+    df = pd.DataFrame({INDEX_CODES['SA1']: codes})
+    for level, size in GROUPS.items():
+        df[INDEX_CODES[level]] = [level + str(i // size) for i in range(len(codes))]
+    df.to_csv(path, index=False)
+    return (path, raw, df.set_index(INDEX_CODES['SA1']))
+
+
+def test_rollup_sums(datapack_dir, tmp_path):
+    path, raw, parents = concordance(datapack_dir, tmp_path)
+    features = build_rollup(datapack_dir, list(GROUPS), path, cache=False, compact=False)
+
+    population = raw['Tot_P_P']
+    for level in GROUPS:
+        df = features[level].set_index(INDEX_CODES[level])
+        expected = population.groupby(parents[INDEX_CODES[level]].reindex(population.index).to_numpy()).sum()
+        expected = expected[expected > 0]
+        pd.testing.assert_series_equal(df['population'].sort_index(), expected.sort_index(), check_names=False,
+                                       check_index_type=False)
+        assert df['population'].sum() == features['SA1']['population'].sum()
+        occupations = [col for col in df.columns if col.startswith('occupation_total_') and
+                       not col.endswith('_standardised')]
+        assert np.allclose(df[occupations].sum(), features['SA1'][occupations].sum())
+
+
+def test_rollup_refuses_unmapped_areas(datapack_dir, tmp_path):
+    codes = source_abs.DataPack('SA1', datapack_dir, cache=False).read_source('population').index
+    path, _, _ = concordance(datapack_dir, tmp_path, codes[:len(codes) // 2])
+    with pytest.raises(ValueError, match='no SA2 in the concordance'):
+        build_rollup(datapack_dir, ['SA2'], path, cache=False)
+
+
+def test_rollup_refuses_areas_missing_from_g01(datapack_dir):
+    # Parents are given to the codes of G01; an area of another table without one would vanish
+    pack = source_abs.DataPack('SA1', datapack_dir, cache=False)
+    raw = {name: pack.read_source(name) for name in SOURCES}
+    codes = raw['population'].index
+    parents = pd.Series(['SA2_' + code[:3] for code in codes], index=codes, name=INDEX_CODES['SA2'])
+    aggregate_sources(raw, parents)
+    with pytest.raises(ValueError, match='SA1 codes of G17A/G17B/G17C have no SA2_MAINCODE_2016'):
+        aggregate_sources(raw, parents.iloc[1:])
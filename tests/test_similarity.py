@@ -0,0 +1,63 @@
+# Top-k similar areas: blocked search against a full sort, and the approximate index
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from source_abs import (build_features, feature_matrix, prepare_rows, top_k, similar_areas, build_similarity_index,
+                        load_similarity_index)
+
+
+@pytest.fixture(scope='module')
+def features(datapack_dir):
+    return (build_features('POA', datapack_dir, cache=False, compact=False))
+
+
+@pytest.mark.parametrize('metric', ['cosine', 'euclidean'])
+def test_top_k_matches_full_sort(metric):
+    rng = np.random.default_rng(0)
+    x = prepare_rows(rng.normal(size=(300, 12)).astype('float32'), metric)
+    queries = x[:7]
+    found, score = top_k(queries, x, k=5, metric=metric, block_rows=64, exclude=np.arange(7))
+
+    if metric == 'cosine':
+        full = queries @ x.T
+    else:
+        full = -np.sqrt(((queries[:, None] - x[None]) ** 2).sum(axis=2))
+    full[np.arange(7), np.arange(7)] = -np.inf
+    expected = np.argsort(-full, axis=1, kind='stable')[:, :5]
+    assert (found == expected).all()
+    expected_score = np.take_along_axis(full, expected, axis=1)
+    assert np.allclose(score, expected_score if metric == 'cosine' else -expected_score, atol=1e-5)
+
+
+def test_similar_areas(features):
+    codes = list(features.iloc[:3, 0])
+    result = similar_areas(features, codes, k=4)
+    assert list(result['code']) == [code for code in codes for _ in range(4)]
+    assert list(result['rank']) == [1, 2, 3, 4] * 3
+    assert not (result['code'] == result['similar_code']).any()
+    for _, group in result.groupby('code'):
+        assert (np.diff(group['score']) <= 1e-6).all()
+    with pytest.raises(KeyError, match='Unknown code'):
+        similar_areas(features, ['nowhere'])
+
+
+def test_index_searching_every_list_is_exact(features, tmp_path):
+    path = str(tmp_path / 'index.npz')
+    build_similarity_index(features, path, lists=6)
+    index = load_similarity_index(path)
+    codes = list(features.iloc[::10, 0])
+    exact = similar_areas(features, codes, k=5)
+    pd.testing.assert_frame_equal(similar_areas(features, codes, k=5, index=index, probes=6), exact,
+                                  check_dtype=False, check_exact=False, atol=1e-5)
+    # fewer lists searched: a subset of the areas, still ranked
+    approximate = similar_areas(features, codes, k=5, index=index, probes=1)
+    assert len(approximate) <= len(exact) and approximate['similar_code'].isin(features.iloc[:, 0]).all()
+
+
+def test_feature_matrix_standardises(features):
+    codes, x, columns = feature_matrix(features)
+    assert x.dtype == 'float32' and x.shape == (len(features), len(columns))
+    assert np.allclose(x.mean(axis=0), 0, atol=1e-5)
+    assert np.isfinite(x).all()
@@ -0,0 +1,32 @@
+# A feature spec gives the built-in stages' features, reading the tables as they do
+
+import os
+
+from source_abs import build_features, add_event_sink, remove_event_sink
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPEC = os.path.join(ROOT, 'features.ini')
+
+
+def built(datapack_dir, **options):
+    return (build_features('POA', datapack_dir, compact=False, **options))
+
+
+def test_spec_matches_stages(datapack_dir):
+    expected = built(datapack_dir, cache=False).to_csv(index=False)
+    assert built(datapack_dir, cache=False, spec=SPEC).to_csv(index=False) == expected
+
+
+def test_spec_shares_the_stages_table_cache(datapack_dir, tmp_path):
+    # Same columns and dtypes, so the same cache entries: nothing is parsed again
+    cache_dir = str(tmp_path / 'cache')
+    built(datapack_dir, cache_dir=cache_dir)
+    entries = sorted(os.listdir(cache_dir))
+    origins = []
+    sink = add_event_sink(lambda event: origins.append(event['origin']) if event['event'] == 'read' else None)
+    try:
+        built(datapack_dir, cache_dir=cache_dir, spec=SPEC)
+    finally:
+        remove_event_sink(sink)
+    assert origins and 'source' not in origins
+    assert sorted(os.listdir(cache_dir)) == entries
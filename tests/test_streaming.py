@@ -0,0 +1,28 @@
+# Streaming chunk by chunk gives the in-memory build's output
+
+import shutil
+
+import pandas as pd
+import pytest
+
+from source_abs import DataPack, build_features, stream_features
+
+
+@pytest.mark.parametrize('filters', [None, []])
+def test_stream_matches_in_memory(datapack_dir, tmp_path, filters):
+    output = str(tmp_path / 'streamed.csv')
+    rows = stream_features('POA', datapack_dir, output, chunk_rows=40, filters=filters)
+    expected = build_features('POA', datapack_dir, cache=False, compact=False, filters=filters)
+    assert rows == len(expected)
+    with open(output) as f:
+        assert f.read() == expected.to_csv(index=False)
+
+
+def test_stream_refuses_unaligned_tables(datapack_dir, tmp_path):
+    # The rows of G40 in another order than those of the other tables
+    pack = DataPack('POA', tmp_path)
+    shutil.copytree(DataPack('POA', datapack_dir).dir, pack.dir)
+    path = pack.source('G40')[0]
+    pd.read_csv(path, dtype=str).iloc[::-1].to_csv(path, index=False)
+    with pytest.raises(ValueError, match='G40 are not aligned'):
+        stream_features('POA', str(tmp_path), str(tmp_path / 'streamed.csv'), chunk_rows=40)